@@ -12,8 +12,11 @@ Examples:
   --json [File, json file to parse ]
   --tool_version '2.1.0'
   --contig [File, contig file]
-  > 'output.vcf'
+  --output 'output.vcf'
 Note: All the variants use "N" in REF and ALT column
+The vcf is written to standard output without --output, and BGZF compressed
+(without a tabix index, the fusions being in the order of the fusion file)
+when the output ends in '.gz'
 
 Example json file:
 Arriba_fusion.min.v1.json - for Arriba tsv conversion
@@ -28,6 +31,14 @@ Example contig file
 
 import argparse
 import json
+import os
+import sys
+
+# vcfio is shared with the vcf_utils scripts
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "vcf_utils")
+)
+from vcfio import BgzfWriter, open_vcf
 
 
 def retrieve_required_entry(data, tag, content):
@@ -74,47 +85,68 @@ parser.add_argument(
     type=str,
     help="version of the fusion tool",
 )
+parser.add_argument(
+    "--output",
+    "-o",
+    type=str,
+    help="path to the output vcf, BGZF compressed if it ends in .gz "
+    "(default=standard output)",
+)
 args = parser.parse_args()
 args.version = version
+if not args.output:
+    vcf_out = sys.stdout
+elif args.output.endswith(".gz"):
+    # The fusions are not sorted by position, so they cannot be indexed
+    vcf_out = BgzfWriter(args.output, index=False)
+else:
+    vcf_out = open_vcf(args.output, "w")
 
 with open(args.json) as json_file:
     data = json.load(json_file)
 
 # start to print headers
-print("##fileformat=VCFv4.3")
-print("##source={}_v{}".format(data["source"], args.tool_version))
-print('##ALT=<ID=BND,Description="Break end">')
+print("##fileformat=VCFv4.3", file=vcf_out)
+print("##source={}_v{}".format(data["source"], args.tool_version), file=vcf_out)
+print('##ALT=<ID=BND,Description="Break end">', file=vcf_out)
 print(
     '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural \
-variant">'
+variant">',
+    file=vcf_out,
 )
 print(
     '##INFO=<ID=ROWID,Number=1,Type=String,Description="Breakend ID of the \
-breakend at reference position">'
+breakend at reference position">',
+    file=vcf_out,
 )
 print(
     '##INFO=<ID=MATEID,Number=1,Type=String,Description="Breakend ID of the \
-mate breakend">'
+mate breakend">',
+    file=vcf_out,
 )
 print(
     '##INFO=<ID=EVENT,Number=1,Type=String,Description="Event identifier for \
-a rearrangement">'
+a rearrangement">',
+    file=vcf_out,
 )
 print(
     '##INFO=<ID=VARTYPE,Number=1,Type=String,Description="Type of \
-variant/arrangement">'
+variant/arrangement">',
+    file=vcf_out,
 )
 print(
     '##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the \
-variant described in this record">'
+variant described in this record">',
+    file=vcf_out,
 )
-print('##INFO=<ID=GENEA,Number=1,Type=String,Description="Gene A">')
-print('##INFO=<ID=GENEB,Number=1,Type=String,Description="Gene B">')
+print('##INFO=<ID=GENEA,Number=1,Type=String,Description="Gene A">', file=vcf_out)
+print('##INFO=<ID=GENEB,Number=1,Type=String,Description="Gene B">', file=vcf_out)
 print(
     '##INFO=<ID=ORIENTATION,Number=1,Type=String,Description="Orientation of \
-the fusion">'
+the fusion">',
+    file=vcf_out,
 )
-print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">', file=vcf_out)
 
 
 # define the INFO and FORMAT columns
@@ -134,7 +166,8 @@ for entry in sorted(data["custom"].keys()):
                 data["custom"][entry]["number"],
                 data["custom"][entry]["type"],
                 data["custom"][entry]["description"],
-            )
+            ),
+            file=vcf_out,
         )
         if "FORMAT" == data["custom"][entry]["entry"]:
             required_format += ":{}".format(entry)
@@ -173,23 +206,29 @@ if data["filter"]["filter"]:
 
         if not "delimiter" in data["filter"]:
             if not content[data["filter"]["column"]] in filter_set:
-                print(filter_string.format(content[data["filter"]["column"]]))
+                print(
+                    filter_string.format(content[data["filter"]["column"]]),
+                    file=vcf_out,
+                )
             filter_set.add(content[data["filter"]["column"]])
         else:
             for entry in content[data["filter"]["column"]].split(
                 data["filter"]["delimiter"]
             ):
                 if not entry in filter_set:
-                    print(filter_string.format(entry))
+                    print(filter_string.format(entry), file=vcf_out)
             filter_set.add(entry)
 
 # print contigs to the header
 with open(args.contig, "r") as contig_file:
     for line in contig_file:
-        print(line.strip("\n"))
+        print(line.strip("\n"), file=vcf_out)
 
 # print the last line of header
-print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}".format(args.sample))
+print(
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}".format(args.sample),
+    file=vcf_out,
+)
 
 
 i = 1
@@ -285,11 +324,16 @@ for line in open(args.fusion):
     print(
         vcf_columns.format(
             chrA, posA, ".", "N", altA, qual, filt, INFOA, required_format, FORMAT
-        )
+        ),
+        file=vcf_out,
     )
     print(
         vcf_columns.format(
             chrB, posB, ".", "N", altB, qual, filt, INFOB, required_format, FORMAT
-        )
+        ),
+        file=vcf_out,
     )
     i += 1
+
+if vcf_out is not sys.stdout:
+    vcf_out.close()
@@ -9,6 +9,7 @@ For fusion vcf, replace the "N" base in ALT from REF
 Example:
 'replace_N_fusion_vcf.py'
   --input [File, vcf file from bcftools +fill-from-fasta]
+  --threads [Int, number of processes replacing chunks of records (default 1)]
   > [String, output vcf]
 
 Example to run bcftools
@@ -22,17 +23,35 @@ bcftools +fill-from-fasta
 """
 
 import argparse
+import os
+import sys
+
+# vcfio is shared with the vcf_utils scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'vcf_utils'))
+from vcfio import read_header, map_records
+
+
+def replace_n(lines):
+    """Replace the "N" base in ALT from REF in the records, as vcf text
+    """
+    output = []
+    for line in lines:
+        line=line.strip('\n').split('\t')
+        ref=line[3]
+        line[4]=line[4].replace("N", ref)
+        output.append("\t".join(line) + '\n')
+    return ''.join(output)
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--input', required=True, type=str, help="path to input vcf")
+parser.add_argument('--threads', type=int, default=1, help="number of processes replacing chunks of records (default 1)")
 args = parser.parse_args()
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
 
-with open(args.input, 'r') as f:
-    for line in f:
-        if line.startswith("#"):
-            print(line.strip('\n'))
-        else:
-            line=line.strip('\n').split('\t')
-            ref=line[3]
-            line[4]=line[4].replace("N", ref)
-            print("\t".join(line))
-
+for line in read_header(args.input):
+    print(line.strip('\n'))
+for text in map_records(args.input, replace_n, threads=args.threads):
+    sys.stdout.write(text)
@@ -0,0 +1,85 @@
+"""
+Reading the pileups of a bam file (add_bam_stats.py --bam) against the
+samtools mpileup output of the same bam, in tests/data/bam_pileup
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+VCF_UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'vcf_utils')
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                    'bam_pileup')
+sys.path.insert(0, VCF_UTILS)
+
+from pileup import BamPileup, PileupDict  # noqa: E402
+
+
+def read_fasta(name):
+    sequences, contig = {}, None
+    with open(name) as f:
+        for line in f:
+            if line.startswith('>'):
+                contig = line[1:].split()[0]
+                sequences[contig] = []
+            else:
+                sequences[contig].append(line.strip())
+    return {contig: ''.join(lines) for contig, lines in sequences.items()}
+
+
+class TestBamPileup(unittest.TestCase):
+
+    def test_columns(self):
+        """Depth, bases, indels, read starts and ends of every position of
+        the mpileup
+        """
+        reference = read_fasta(os.path.join(DATA, 'reference.fa'))
+        with PileupDict(os.path.join(DATA, 'sample.mpileup')) as mpileup, \
+                BamPileup(os.path.join(DATA, 'sample.bam')) as bam:
+            for key in list(mpileup._lines):
+                contig, pos = key.split('\t')
+                pos = int(pos)
+                # The deleted bases are shown from the reference
+                ref = reference[contig][pos - 1:pos + 10]
+                expected = mpileup.get(contig, pos)
+                column = bam.get(contig, pos, ref)
+                with self.subTest(position=key):
+                    self.assertEqual(column[0], expected[0])
+                    for name in ('bases', 'insertions', 'deletions',
+                                 'starts', 'ends'):
+                        self.assertEqual(getattr(column[1], name),
+                                         getattr(expected[1], name), name)
+
+    def add_bam_stats(self, tmp_dir, name, *options):
+        output = os.path.join(tmp_dir, name)
+        subprocess.run([sys.executable,
+                        os.path.join(VCF_UTILS, 'add_bam_stats.py'),
+                        '-i', os.path.join(DATA, 'sample.vcf'), '-o', output,
+                        '--type', 'germline'] + list(options), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(output) as f:
+            return f.read()
+
+    def check_annotations(self, mpileup, *options):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            expected = self.add_bam_stats(
+                tmp_dir, 'mpileup.vcf', '--mpileup',
+                os.path.join(DATA, mpileup), *options)
+            annotated = self.add_bam_stats(
+                tmp_dir, 'bam.vcf', '--bam', os.path.join(DATA, 'sample.bam'),
+                *options)
+        self.assertEqual(annotated, expected)
+
+    def test_add_bam_stats(self):
+        self.check_annotations('sample.mpileup')
+
+    def test_add_bam_stats_qualities(self):
+        self.check_annotations('sample.mq.mpileup', '--min-baseq', '20',
+                               '--min-mapq', '30')
+
+
+if __name__ == '__main__':
+    unittest.main()
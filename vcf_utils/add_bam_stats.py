@@ -7,56 +7,373 @@ Date: 28-02-2019
 
 Add variant statistics from bam file to vcf.
 Works on both germline and somatic variants.
-Users are advised to run mpileup tools to generate mpileup file. 
+Users are advised to run mpileup tools to generate mpileup file.
 Example samtools command:
 samtools mpileup -A -B -Q 0 -d 10000 -l regions.tsv -f reference.fa bam_file > mpileup_file
+Or the mpileup is read from the standard input ('-') or from a command ending in '|' (e.g. 'samtools mpileup ... bam_file |'), annotating while samtools runs, and exiting with an error if it fails
+Or the bam file (indexed with .bai) is given instead, and read at the variant positions only, with the same settings
+With --build-cache, the counts of each mpileup are written to a binary store (mpileup + '.counts'), which the later runs read instead of the mpileup while it is up to date
+With --samples, all the samples of a multi-sample vcf are annotated in one pass, from the sample columns of a multi-sample mpileup (samtools mpileup bam_1 ... bam_n) or from one bam per sample
+With --min-baseq / --min-mapq, only the reads of at least these base / mapping qualities are counted (from the quality columns of the mpileup, and the mapping quality column of samtools mpileup -s / --output-MQ), so that one mpileup run with -Q 0 serves every threshold
+With --threads N, chunks of records are annotated by N processes (reading the bam files, count stores, or mpileups at the positions of each chunk), and written back in the order of the vcf
+With --manifest, the somatic vcfs of several tumours sharing one normal are annotated by --threads processes, the normal mpileup being counted once into a count store read by all of them
+With --sorted-inputs, the vcf and mpileups (sorted in the order of the vcf ##contig lines) are read together as a stream, in constant memory
+The pileup counts of a position are cached for all its records (split multi-allelics, several callers), and the cache hits / misses reported on stderr
+The reads supporting the ALT of an MNP are not known from the pileup (one base per read), and are written as '.'
 
 Examples
 For Germline (or Tumour only) data
 combine_vcf.py
 add_bam_stats.py
   -i [File, vcf]
-  --mpileup [File, mpileup output of bam]
+  --mpileup [File, mpileup output of bam] (or --bam [File, bam])
   --type 'germline'
   -o [String, output filename]
 
 For Somatic paired data
 add_bam_stats.py
   -i [File, vcf]
-  --normal_mpileup [File, mpileup output of normal bam]
-  --tumor_mpileup [File, mpileup output of tumor bam]
+  --normal_mpileup [File, mpileup output of normal bam] (or --normal_bam)
+  --tumor_mpileup [File, mpileup output of tumor bam] (or --tumor_bam)
   --tumor_id [String, tumor sample id]
   --type 'somatic'
   -o [String, output filename]
 
+For several tumours paired with one normal
+add_bam_stats.py
+  --manifest [File, tab separated lines: tumor vcf, tumor mpileup or bam, output filename, tumor sample id]
+  --normal_mpileup [File, mpileup output of normal bam] (or --normal_bam)
+  --normal_id [String, normal sample id]
+  --type 'somatic'
+
 """
 
 ###############################################################################
 
-import re
 import argparse
+import os
 import sys
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from variant import Variant, BAM_STATS_LINES
+from vcfio import open_vcf, read_vcf, parse_region, read_bed, \
+    header_contigs, is_compressed, find_index
+from pileup import PileupDict, PileupStream, BamPileup, CountStore, \
+    PileupCache, QualityFilter, write_count_store, find_count_store, \
+    count_store_qualities, store_qualities, is_pipe, mpileup_contig_ranges, \
+    COUNT_STORE_EXT
+
+# Number of vcf records annotated at once by a process of --threads
+THREAD_CHUNK = 10000
 
 
 ###############################################################################
 
-def create_mpileup_dict(mpileup):
-    """Use the mpileup file to create a dictionary
-       {'chr\tpos':mpileup_line}
+def open_pileup(mpileup, bam=None, regions=None, order=None, quality=None,
+                ranges=None):
+    """Pileup source of a bam file if given, otherwise of an mpileup file (or
+       of a count store given instead): its count store if up to date, a dictionary of the whole file (or of the
+       positions in the regions, read from the byte ranges of its contigs if
+       given), or a stream along the vcf if the contig order {contig: rank}
+       of the sorted vcf is given
+       Only the reads passing the QualityFilter are counted, if given
     """
-    try:
-        f = open(mpileup, 'r')
-    except:
-        sys.exit('Failed to open file {}'.format(mpileup))
-    mpileup_dict = {}
-    with open(mpileup, 'r') as f:
-        for line in f:
-            line = line.split()
-            # clean up the start or end of read from mpileup line
-            line[4] = re.sub(r'(\^.|\$)', '', line[4])
-            mpileup_dict.update({'\t'.join(line[:2]): line[3:5]})
-    return mpileup_dict
+    if bam is not None:
+        if quality is None:
+            return BamPileup(bam)
+        return BamPileup(bam, min_baseq=quality.min_baseq,
+                         min_mapq=quality.min_mapq)
+    # A count store given directly, or the one of the mpileup
+    qualities = count_store_qualities(mpileup)
+    if qualities is not None:
+        if qualities != store_qualities(quality):
+            sys.exit('Count store {} counts the reads of other base / mapping \
+quality thresholds'.format(mpileup))
+        return CountStore(mpileup)
+    store = find_count_store(mpileup, quality)
+    if store is not None:
+        return CountStore(store)
+    if order is None:
+        return PileupDict(mpileup, regions, quality, ranges)
+    return PileupStream(mpileup, order, regions, quality)
+
+
+def open_sources(sources, open_source):
+    """[(pileup source, sample column)] of the [(mpileup, bam, sample
+       column)] of the samples annotated, each file opened once by
+       open_source(mpileup, bam)
+    """
+    opened = {}
+    pileups = []
+    for mpileup, bam, sample in sources:
+        if (mpileup, bam) not in opened:
+            opened[(mpileup, bam)] = open_source(mpileup, bam)
+        pileups.append((opened[(mpileup, bam)], sample))
+    return pileups
+
+
+def unique_sources(pileups):
+    """The pileup sources of [(pileup source, sample column)], once each
+    """
+    unique = []
+    for pileup, _ in pileups:
+        if all(pileup is not source for source in unique):
+            unique.append(pileup)
+    return unique
+
+
+def annotate(line, somatic, pileups, columns):
+    """The vcf line of a record with its bam stats, from the [(pileup source,
+       sample column)] of the samples annotated
+       columns: (samples annotated, samples of the vcf) if germline (None,
+       None for a single sample vcf), (normal index, tumor index) if somatic
+    """
+    if somatic:
+        normal_index, tumor_index = columns
+        variant = Variant().read_variant(line, somatic=True,
+                                         normal=normal_index,
+                                         tumor=tumor_index)
+        bam_stats = [variant.cal_bam_stats(
+            pileup.get(variant.chr, variant.pos, variant.ref))
+            for pileup, _ in pileups]
+        variant = variant.add_bam_stats(bam_stats, somatic=True)
+        return variant.write(somatic=True)
+
+    samples, vcf_samples = columns
+    if samples is None:
+        variant = Variant().read_variant(line)
+        mpileup, sample = pileups[0]
+        bam_stats = variant.cal_bam_stats(
+            mpileup.get(variant.chr, variant.pos, variant.ref, sample))
+    else:
+        variant = Variant().read_variant(line, samples=vcf_samples)
+        bam_stats = {}
+        for name, (mpileup, sample) in zip(samples, pileups):
+            bam_stats[name] = variant.cal_bam_stats(
+                mpileup.get(variant.chr, variant.pos, variant.ref, sample))
+    variant = variant.add_bam_stats(bam_stats)
+    return variant.write()
+
+###############################################################################
+
+# The bam files and count stores opened by a process of --threads, for all its
+# chunks
+_worker_sources = {}
+
+
+def mpileup_ranges(mpileup, quality=None):
+    """Byte ranges {contig: (start, end)} of the contigs of a plain mpileup,
+       bisected by the processes of --threads (None for a count store or a
+       tabix indexed mpileup, which are read directly)
+    """
+    if is_pipe(mpileup):
+        sys.exit('--threads requires mpileup files, not pipes')
+    if find_count_store(mpileup, quality) is not None:
+        return None
+    if not is_compressed(mpileup):
+        return mpileup_contig_ranges(mpileup)
+    if find_index(mpileup) is None:
+        sys.exit('--threads requires a plain or a tabix indexed mpileup: {}'
+                 .format(mpileup))
+    return None
+
+
+def _worker_pileup(mpileup, bam, regions, quality, ranges):
+    """Pileup source of a chunk in a process of --threads: the bam file or
+       count store opened once per process, or the mpileup lines at the
+       positions of the chunk
+    """
+    if bam is None and find_count_store(mpileup, quality) is None:
+        return open_pileup(mpileup, None, regions, None, quality, ranges)
+    if (mpileup, bam) not in _worker_sources:
+        _worker_sources[(mpileup, bam)] = open_pileup(mpileup, bam,
+                                                      quality=quality)
+    return _worker_sources[(mpileup, bam)]
+
+
+def _annotate_chunk(job):
+    """Annotate a chunk of vcf records in a process of --threads
+       Output the annotated lines, and the [(name, hits, misses)] of the
+       pileup caches
+    """
+    lines, (somatic, sources, columns, quality, ranges) = job
+    # The mpileups are read over the span of the chunk on each contig, at
+    # once rather than position by position
+    spans = OrderedDict()
+    for line in lines:
+        line = line.split('\t', 2)
+        pos = int(line[1])
+        beg, end = spans.get(line[0], (pos - 1, pos))
+        spans[line[0]] = (min(beg, pos - 1), max(end, pos))
+    regions = [(contig, beg, end) for contig, (beg, end) in spans.items()]
+    pileups = open_sources(sources, lambda mpileup, bam: _worker_pileup(
+        mpileup, bam, regions, quality, ranges.get(mpileup)))
+    # The caches of the bam files and count stores are kept across chunks
+    counts = [(pileup, pileup.cache.hits, pileup.cache.misses)
+              for pileup in unique_sources(pileups)]
+    text = ''.join(annotate(line, somatic, pileups, columns)
+                   for line in lines)
+    return text, [(pileup.name, pileup.cache.hits - hits,
+                   pileup.cache.misses - misses)
+                  for pileup, hits, misses in counts]
+
+
+def annotate_chunks(pool, records, job, threads):
+    """Yield the outputs of _annotate_chunk for the chunks of THREAD_CHUNK
+       records, in order, with at most 2 chunks per process in flight
+    """
+    pending = deque()
+    while True:
+        lines = list(islice(records, THREAD_CHUNK))
+        if not lines:
+            break
+        pending.append(pool.submit(_annotate_chunk, (lines, job)))
+        if len(pending) >= 2 * threads:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_records(vcf_in, regions=None):
+    """The lines of a vcf (only the records overlapping the regions, if
+       given), and the regions of the mpileup lines needed (None for all)
+    """
+    if regions is None:
+        return read_vcf(vcf_in), None
+    # The mpileup lines needed are at the positions of the selected variants
+    # (which may start before the regions)
+    vcf_lines = list(read_vcf(vcf_in, regions))
+    pileup_regions = []
+    for line in vcf_lines:
+        if not line.startswith('#'):
+            line = line.split('\t', 2)
+            pileup_regions.append((line[0], int(line[1]) - 1, int(line[1])))
+    return vcf_lines, pileup_regions
+
+
+def annotate_vcf(vcf_lines, vcf_out, somatic, sources, ids, quality=None,
+                 regions=None, sorted_inputs=False, threads=1):
+    """Write the vcf lines to vcf_out, with the bam stats of the [(mpileup,
+       bam, sample column)] sources of the samples annotated
+       ids: the samples annotated if germline (None for a single sample vcf),
+       (normal id, tumor id) if somatic
+       Output the [(name, PileupCache)] of the pileup sources
+    """
+    # The meta-information lines, for the contig order of --sorted-inputs
+    meta_info = []
+
+    with open_vcf(vcf_out, 'w') as f_vcf_out:
+        records = iter(vcf_lines)
+        for line in records:
+
+            # Write the header lines
+            if line.startswith('##'):
+                f_vcf_out.write(line)
+                meta_info.append(line)
+                continue
+            for new_line in BAM_STATS_LINES:
+                f_vcf_out.write(new_line)
+
+            # The columns of the samples in the vcf
+            if not somatic:
+                f_vcf_out.write(line)
+                vcf_samples = None
+                if ids is not None:
+                    vcf_samples = line.rstrip('\n').split('\t')[9:]
+                    for sample in ids:
+                        if sample not in vcf_samples:
+                            sys.exit('Failed to match sample id {}'.format(
+                                sample))
+                columns = (ids, vcf_samples)
+            else:
+                normal_id, tumor_id = ids
+                line = line.split()
+                try:
+                    normal_index = line.index(normal_id)
+                except:
+                    sys.exit('Failed to match normal sample id')
+                try:
+                    tumor_index = line.index(tumor_id)
+                except:
+                    sys.exit('Failed to match tumor sample id')
+                line = '\t'.join(line[:-2] + [normal_id, tumor_id+'\n'])
+                f_vcf_out.write(line)
+                columns = (normal_index, tumor_index)
+            break
+
+        if threads > 1:
+            # Chunks of records annotated by the worker processes, written
+            # back in the order of the vcf
+            ranges = {mpileup: mpileup_ranges(mpileup, quality)
+                      for mpileup, bam, _ in sources if bam is None}
+            job = (somatic, sources, columns, quality, ranges)
+            caches = OrderedDict()
+            with ProcessPoolExecutor(max_workers=threads) as pool:
+                for text, stats in annotate_chunks(pool, records, job,
+                                                   threads):
+                    f_vcf_out.write(text)
+                    for name, hits, misses in stats:
+                        cache = caches.setdefault(name, PileupCache())
+                        cache.hits += hits
+                        cache.misses += misses
+            return list(caches.items())
+
+        # Read the mpileup file, and store into dictionary
+        # Due to multi-allelic variants, need to read the whole
+        # mpileup file in first, unless it is read along the sorted vcf
+        order = None
+        if sorted_inputs:
+            order = {contig: i for i, contig in
+                     enumerate(header_contigs(meta_info))}
+        pileups = open_sources(sources, lambda mpileup, bam: open_pileup(
+            mpileup, bam, regions, order, quality))
+
+        # Calcualte bam stats for variants
+        for line in records:
+            f_vcf_out.write(annotate(line, somatic, pileups, columns))
+
+    caches = []
+    for pileup in unique_sources(pileups):
+        pileup.close()
+        caches.append((pileup.name, pileup.cache))
+    return caches
+
+
+def read_manifest(manifest):
+    """The [(tumor vcf, tumor mpileup or bam, output vcf, tumor id)] of the
+       tab separated lines of a manifest (skipping the lines starting with
+       '#')
+    """
+    rows = []
+    with open(manifest) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            row = line.rstrip('\n').split('\t')
+            if len(row) != 4:
+                sys.exit('Line {} of manifest {} does not have the 4 columns: \
+vcf, tumor mpileup or bam, output vcf, tumor id'.format(n, manifest))
+            rows.append(tuple(row))
+    if not rows:
+        sys.exit('Manifest {} is empty'.format(manifest))
+    return rows
+
+
+def _annotate_tumor(job):
+    """Annotate the vcf of one tumour of a manifest, in a process of
+       --manifest. Output the [(name, PileupCache)] of its pileup sources
+    """
+    (vcf_in, tumor, vcf_out, ids, normal, regions, quality,
+     sorted_inputs) = job
+    if tumor.endswith('.bam'):
+        tumor = (None, tumor, 0)
+    else:
+        tumor = (tumor, None, 0)
+    vcf_lines, pileup_regions = read_records(vcf_in, regions)
+    return annotate_vcf(vcf_lines, vcf_out, True, [normal, tumor], ids,
+                        quality, pileup_regions, sorted_inputs)
 
 ###############################################################################
 
@@ -68,51 +385,147 @@ parser = argparse.ArgumentParser(description='Get stats from bam file and \
                                  write to vcf')
 optional = parser._action_groups.pop()
 required = parser.add_argument_group('required arguments')
-required.add_argument("-i",  help="input vcf", required=True)
-required.add_argument("-o", help="output vcf", required=True)
+required.add_argument("-i",  help="input vcf (plain or gzip/BGZF \
+                      compressed), except with --manifest", required=False)
+required.add_argument("-o", help="output vcf, BGZF compressed and tabix \
+                      indexed if the name ends in .gz, except with \
+                      --manifest", required=False)
 required.add_argument("--type", help="must be either germline or somatic",
                       required=True, choices=recognised_modes)
 parser._action_groups.append(optional)
 required.add_argument("--mpileup", help="mpileup file extracted from bam \
-                      file", required=False)
+                      file ('-' for the standard input, or a command ending \
+                      in '|' whose output is read as it runs)",
+                      required=False)
 required.add_argument("--normal_mpileup", help="mpileup file extracted from the normal sample bam, \
                       required if input is somatic vcf", required=False)
 required.add_argument("--tumor_mpileup", help="mpileup file extracted from the tumor sample, \
                       required if input is somatic vcf", required=False)
+required.add_argument("--bam", help="bam file (indexed with .bai or .csi), \
+                      instead of the mpileup. With --samples, this parameter \
+                      is specified once per sample", action="append")
+required.add_argument("--normal_bam", help="bam file of the normal sample, \
+                      instead of the normal mpileup", required=False)
+required.add_argument("--tumor_bam", help="bam file of the tumor sample, \
+                      instead of the tumor mpileup", required=False)
 required.add_argument("--normal_id", help="Normal sample id, \
                       required if input is somatic vcf", required=False)
 required.add_argument("--tumor_id", help="Tumor sample id, \
                       required if input is somatic vcf", required=False)
+optional.add_argument("--manifest", help="somatic vcfs of several tumours \
+                      sharing the normal (--normal_mpileup or --normal_bam, \
+                      and --normal_id): tab separated lines of the tumour \
+                      vcf, tumour mpileup (or bam, ending in .bam), output \
+                      vcf and tumour id. The normal is counted once, and \
+                      the tumours are annotated by the --threads processes",
+                      required=False)
+optional.add_argument("--samples", help="comma separated ids of the vcf \
+                      samples to annotate (germline), in the order of the \
+                      sample columns of the mpileup (or of the --bam files)",
+                      required=False)
+optional.add_argument("--region", help="only annotate the variants in the \
+                      region chr:start-end (1-based). Seeks with the .tbi / \
+                      .csi index of compressed vcf / mpileup files. This \
+                      parameter can be specified more than once",
+                      action="append")
+optional.add_argument("--regions-bed", help="only annotate the variants in \
+                      the regions of this bed file", required=False)
+optional.add_argument("--sorted-inputs", help="the vcf and mpileups are \
+                      sorted in the order of the vcf ##contig lines. Read the \
+                      mpileups along the vcf, in constant memory, instead of \
+                      loading them first", action="store_true")
+optional.add_argument("--min-baseq", help="only count the bases of at least \
+                      this base quality (default 0)", type=int, default=0)
+optional.add_argument("--min-mapq", help="only count the reads of at least \
+                      this mapping quality (default 0). Mpileups must have \
+                      the mapping quality column of samtools mpileup \
+                      -s (--output-MQ)", type=int, default=0)
+optional.add_argument("--threads", help="number of processes annotating \
+                      chunks of records (default: 1). The bam files, count \
+                      stores and tabix indexed mpileups are read at the \
+                      positions of each chunk, and plain mpileups by \
+                      bisection, their lines being grouped by contig and \
+                      sorted by position (as samtools writes them)",
+                      type=int, default=1)
+optional.add_argument("--build-cache", help="write the counts of the \
+                      mpileups to binary stores (mpileup + '.counts'), read \
+                      by this and the later runs instead of the mpileups",
+                      action="store_true")
 args = parser.parse_args()
 
 # Input sanity check
-try:
-    f = open(args.i, 'r')
-except:
-    sys.exit('Failed to open file {}'.format(args.i))
-if args.type == 'germline':
+# The standard input can only be read by one of the inputs
+stdin_inputs = [name for name in [args.i, args.mpileup, args.normal_mpileup,
+                                  args.tumor_mpileup] if name == '-']
+if len(stdin_inputs) > 1:
+    sys.exit('only one of -i, --mpileup, --normal_mpileup and --tumor_mpileup \
+can be read from the standard input')
+if args.manifest:
+    if args.type != 'somatic':
+        sys.exit('--manifest requires somatic vcfs')
+    elif args.i or args.o or args.tumor_mpileup or args.tumor_bam or \
+            args.tumor_id:
+        sys.exit('the vcfs, tumor mpileups and ids are given in the manifest')
+    elif not args.normal_mpileup and not args.normal_bam:
+        sys.exit('normal mpileup or bam file is required for somatic vcf')
+    elif not args.normal_id:
+        sys.exit('normal sample id is required for somatic vcf')
+    manifest = read_manifest(args.manifest)
+    if sum(name == '-' for entry in manifest for name in entry[:2]) + \
+            len(stdin_inputs) > 1:
+        sys.exit('only one of the vcfs and mpileups can be read from the \
+standard input')
+    for vcf, tumor, _, _ in manifest:
+        for name in [vcf, tumor]:
+            if is_pipe(name):
+                continue
+            try:
+                f = open(name, 'rb')
+            except:
+                sys.exit('Failed to open file {}'.format(name))
+elif not args.i or not args.o:
+    sys.exit('the input and output vcfs (-i, -o) are required')
+elif args.i != '-':
     try:
-        f = open(args.mpileup, 'r')
+        f = open_vcf(args.i)
     except:
-        sys.exit('Failed to open file {}'.format(args.mpileup))
-elif args.type == 'somatic':
-    if not args.normal_mpileup:
-        sys.exit('normal mpileup file is required for somatic vcf')
-    elif not args.tumor_mpileup:
-        sys.exit('tumor mpileup file is required for somatic vcf')
+        sys.exit('Failed to open file {}'.format(args.i))
+if args.type == 'germline' and not args.manifest:
+    if not args.mpileup and not args.bam:
+        sys.exit('mpileup or bam file is required for germline vcf')
+    for name in args.bam or [args.mpileup]:
+        if is_pipe(name):
+            continue
+        try:
+            f = open(name, 'rb')
+        except:
+            sys.exit('Failed to open file {}'.format(name))
+    if args.bam and len(args.bam) != len((args.samples or '').split(',')):
+        sys.exit('one bam file per sample of --samples is required')
+elif args.type == 'somatic' and not args.manifest:
+    if not args.normal_mpileup and not args.normal_bam:
+        sys.exit('normal mpileup or bam file is required for somatic vcf')
+    elif not args.tumor_mpileup and not args.tumor_bam:
+        sys.exit('tumor mpileup or bam file is required for somatic vcf')
     elif not args.normal_id:
         sys.exit('normal sample id is required for somatic vcf')
     elif not args.tumor_id:
         sys.exit('tumor sample id is required for somatic vcf')
     else:
-        try:
-            f = open(args.normal_mpileup, 'r')
-        except:
-            sys.exit('Failed to open file {}'.format(args.normal_mpileup))
-        try:
-            f = open(args.tumor_mpileup, 'r')
-        except:
-            sys.exit('Failed to open file {}'.format(args.tumor_mpileup))
+        for name in [args.normal_bam or args.normal_mpileup,
+                     args.tumor_bam or args.tumor_mpileup]:
+            if is_pipe(name):
+                continue
+            try:
+                f = open(name, 'rb')
+            except:
+                sys.exit('Failed to open file {}'.format(name))
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
+if args.build_cache and any(is_pipe(name) for name in
+                            [args.mpileup, args.normal_mpileup,
+                             args.tumor_mpileup] if name):
+    sys.exit('--build-cache requires mpileup files, not pipes')
 
 
 ###############################################################################
@@ -125,72 +538,71 @@ normal_mpileup = args.normal_mpileup
 tumor_mpileup = args.tumor_mpileup
 normal_id = args.normal_id
 tumor_id = args.tumor_id
+samples = args.samples.split(',') if args.samples else None
+quality = None
+if args.min_baseq or args.min_mapq:
+    quality = QualityFilter(args.min_baseq, args.min_mapq)
 
-###############################################################################
-
-if vcf_type == 'germline':
-
-    # Read the mpileup file, and store into dictionary
-    # Due to multi-allelic variants, need to read the whole mpileup file in first
-    mpileup_dict = create_mpileup_dict(mpileup_in)
+# Write the count stores of the mpileups, picked up by open_pileup
+if args.build_cache:
+    mpileups = [mpileup_in, normal_mpileup, tumor_mpileup]
+    if args.manifest:
+        mpileups += [tumor for _, tumor, _, _ in manifest
+                     if not tumor.endswith('.bam')]
+    for mpileup in mpileups:
+        if mpileup:
+            write_count_store(mpileup, quality=quality)
 
-    with open(vcf_in, 'r') as f_vcf, open(vcf_out, 'w') as f_vcf_out:
-        for line in f_vcf:
+# Regions to restrict the vcf and mpileups to (None for the whole files)
+target_regions = None
+if args.region or args.regions_bed:
+    target_regions = [parse_region(region) for region in args.region or []]
+    if args.regions_bed:
+        target_regions += read_bed(args.regions_bed)
 
-            # Write the header lines
-            if line.startswith('##'):
-                f_vcf_out.write(line)
-            elif line.startswith('#'):
-                for new_line in BAM_STATS_LINES:
-                    f_vcf_out.write(new_line)
-                f_vcf_out.write(line)
+###############################################################################
 
-            # Calcualte bam stats for variants
-            else:
-                variant = Variant().read_variant(line)
-                mpileup = mpileup_dict.get('\t'.join([variant.chr, variant.pos]),
-                                         '')
-                bam_stats = variant.cal_bam_stats(mpileup)
-                variant = variant.add_bam_stats(bam_stats)
-                f_vcf_out.write(variant.write())
+if args.manifest:
+    # The normal is counted once, into a count store shared by the tumours
+    # (unless it is a bam file, or already has one)
+    normal = (normal_mpileup, args.normal_bam, 0)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(
+            os.path.abspath(manifest[0][2]))) as store_dir:
+        if args.normal_bam is None and \
+           count_store_qualities(normal_mpileup) is None and \
+           find_count_store(normal_mpileup, quality) is None:
+            normal = (write_count_store(normal_mpileup, os.path.join(
+                store_dir, 'normal' + COUNT_STORE_EXT), quality), None, 0)
+        with ProcessPoolExecutor(max_workers=args.threads) as pool:
+            futures = [pool.submit(_annotate_tumor, (
+                vcf, tumor, vcf_o, (normal_id, tumor_id), normal,
+                target_regions, quality, args.sorted_inputs))
+                for vcf, tumor, vcf_o, tumor_id in manifest]
+            for (vcf, tumor, vcf_o, tumor_id), future in zip(manifest,
+                                                              futures):
+                for name, cache in future.result():
+                    print('{}: {}'.format(vcf_o, cache.report(name)),
+                          file=sys.stderr)
 
 else:
+    if vcf_type == 'germline':
+        # The (mpileup, bam, sample column) of each sample annotated
+        if args.bam:
+            sources = [(None, bam, 0) for bam in args.bam]
+        else:
+            sources = [(mpileup_in, None, i) for i in
+                       range(len(samples or [None]))]
+        ids = samples
+    else:
+        sources = [(normal_mpileup, args.normal_bam, 0),
+                   (tumor_mpileup, args.tumor_bam, 0)]
+        ids = (normal_id, tumor_id)
 
-    normal_mpileup_dict = create_mpileup_dict(normal_mpileup)
-    tumor_mpileup_dict = create_mpileup_dict(tumor_mpileup)
-
-    with open(vcf_in, 'r') as vcf_i, open(vcf_out, 'w') as vcf_o:
-        for line in vcf_i:
-            if line.startswith('#'):
-                if line.startswith('##'):
-                    vcf_o.write(line)
-                else:
-                    for new_line in BAM_STATS_LINES:
-                        vcf_o.write(new_line)
-                    line = line.split()
-                    try:
-                        normal_index = line.index(normal_id)
-                    except:
-                        sys.exit('Failed to match normal sample id')
-                    try:
-                        tumor_index = line.index(tumor_id)
-                    except:
-                        sys.exit('Failed to match tumor sample id')
-                    line = '\t'.join(line[:-2] + [normal_id, tumor_id+'\n'])
-                    vcf_o.write(line)
-            else:
-                variant = Variant().read_variant(line, somatic=True,
-                                                 normal=normal_index,
-                                                 tumor=tumor_index)
-                normal_mpileup = normal_mpileup_dict.get('\t'.join([variant.chr,
-                                                       variant.pos]), '')
-                tumor_mpileup = tumor_mpileup_dict.get('\t'.join([variant.chr,
-                                                     variant.pos]), '')
-                normal_bam_stats = variant.cal_bam_stats(normal_mpileup)
-                tumor_bam_stats = variant.cal_bam_stats(tumor_mpileup)
-                variant = variant.add_bam_stats([normal_bam_stats,
-                                                tumor_bam_stats],
-                                                somatic=True)
-                vcf_o.write(variant.write(somatic=True))
-
+    vcf_lines, pileup_regions = read_records(vcf_in, target_regions)
+    caches = annotate_vcf(vcf_lines, vcf_out, vcf_type == 'somatic',
+                          sources, ids, quality, pileup_regions,
+                          args.sorted_inputs, args.threads)
 
+    # Report how often the records at a site shared their pileup counts
+    for name, cache in caches:
+        print(cache.report(name), file=sys.stderr)
@@ -0,0 +1,162 @@
+"""
+Reading of BAM alignments, for add_bam_stats
+
+BamFile reads the header of a BAM file, and fetch(contig, beg, end) yields the
+Alignments overlapping a region, seeking with the .bai / .csi index when there
+is one (otherwise scanning the file)
+"""
+
+import struct
+import sys
+from vcfio import BgzfReader, TabixIndex, find_index
+
+##############################################################################
+
+# CIGAR operations (by their BAM code 0-8: MIDNSHP=X)
+CIGAR_MATCH, CIGAR_INS, CIGAR_DEL, CIGAR_REF_SKIP, CIGAR_SOFT_CLIP, \
+    CIGAR_HARD_CLIP, CIGAR_PAD, CIGAR_EQUAL, CIGAR_DIFF = range(9)
+# Operations consuming the reference, and the query
+CIGAR_REF = frozenset([CIGAR_MATCH, CIGAR_DEL, CIGAR_REF_SKIP, CIGAR_EQUAL,
+                       CIGAR_DIFF])
+CIGAR_QUERY = frozenset([CIGAR_MATCH, CIGAR_INS, CIGAR_SOFT_CLIP, CIGAR_EQUAL,
+                         CIGAR_DIFF])
+
+# 4-bit encoding of the read bases
+SEQ_NT16 = '=ACMGRSVTWYHKDBN'
+
+# Flags
+BAM_FUNMAP, BAM_FREVERSE = 0x4, 0x10
+BAM_FSECONDARY, BAM_FQCFAIL, BAM_FDUP = 0x100, 0x200, 0x400
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID,
+# next_pos, tlen of an alignment record
+ALIGNMENT_CORE = struct.Struct('<iiBBHHHiiii')
+
+##############################################################################
+
+
+class Alignment:
+    """A mapped read
+    pos, end: 0-based start and (exclusive) end on the reference
+    cigar: [(operation, length)]
+    blocks: [(end, operation, start, query start, index in the cigar)] of the
+    operations consuming the reference
+    seq, qual: the 4-bit packed bases and the base qualities (bytes)
+    """
+
+    __slots__ = ('pos', 'end', 'flag', 'mapq', 'cigar', 'blocks', 'seq',
+                 'qual')
+
+    def __init__(self, pos, flag, mapq, cigar, seq, qual):
+        self.pos, self.flag, self.mapq = pos, flag, mapq
+        self.cigar, self.seq, self.qual = cigar, seq, qual
+        self.blocks = []
+        qpos = 0
+        for i, (op, length) in enumerate(cigar):
+            if op in CIGAR_REF:
+                self.blocks.append((pos + length, op, pos, qpos, i))
+                pos += length
+            if op in CIGAR_QUERY:
+                qpos += length
+        self.end = pos
+
+    def base(self, qpos):
+        """Base of the read at the query position
+        """
+        code = self.seq[qpos >> 1]
+        return SEQ_NT16[code & 0xf if qpos & 1 else code >> 4]
+
+    def bases(self, qpos, length):
+        return ''.join(self.base(i) for i in range(qpos, qpos + length))
+
+
+class BamFile:
+    """A BAM file, with its contigs [name] and lengths {name: length}
+    """
+
+    def __init__(self, name):
+        self.name = name
+        try:
+            self._reader = BgzfReader(name)
+            magic = self._reader.read(4)
+        except:
+            sys.exit('Failed to open file {}'.format(name))
+        if magic != b'BAM\1':
+            sys.exit('File {} is not a BAM file'.format(name))
+        l_text = struct.unpack('<i', self._reader.read(4))[0]
+        self._reader.read(l_text)
+        n_ref = struct.unpack('<i', self._reader.read(4))[0]
+        self.contigs, self.lengths = [], {}
+        for _ in range(n_ref):
+            l_name = struct.unpack('<i', self._reader.read(4))[0]
+            contig = self._reader.read(l_name)[:-1].decode()
+            self.contigs.append(contig)
+            self.lengths[contig] = struct.unpack('<i',
+                                                 self._reader.read(4))[0]
+        self._tids = {contig: i for i, contig in enumerate(self.contigs)}
+        # Virtual offset of the first alignment, to scan an unindexed file
+        self._first = self._reader.tell()
+        index_name = find_index(name, ('.bai', '.csi'))
+        self.index = None
+        if index_name is not None:
+            self.index = TabixIndex(index_name, self.contigs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_alignment(self, tid, end):
+        """Read the next alignment record, as (refID, pos, Alignment), the
+        Alignment being None if it is not a mapped read of contig tid
+        starting before end. Output None at the end of the file
+        """
+        block_size = self._reader.read(4)
+        if len(block_size) < 4:
+            return None
+        data = self._reader.read(struct.unpack('<i', block_size)[0])
+        ref_id, pos, l_read_name, mapq, _, n_cigar, flag, l_seq, _, _, _ = \
+            ALIGNMENT_CORE.unpack_from(data)
+        if ref_id != tid or pos >= end or flag & BAM_FUNMAP or not n_cigar:
+            return ref_id, pos, None
+        offset = ALIGNMENT_CORE.size + l_read_name
+        cigar = [(op & 0xf, op >> 4) for op in
+                 struct.unpack_from('<' + 'I' * n_cigar, data, offset)]
+        offset += 4 * n_cigar
+        seq = data[offset:offset + (l_seq + 1) // 2]
+        offset += (l_seq + 1) // 2
+        qual = data[offset:offset + l_seq]
+        return ref_id, pos, Alignment(pos, flag, mapq, cigar, seq, qual)
+
+    def fetch(self, contig, beg, end):
+        """Yield the mapped reads overlapping the 0-based region [beg, end)
+        once, in file order
+        """
+        tid = self._tids.get(contig)
+        if tid is None:
+            return
+        if self.index is not None:
+            chunks = self.index.chunks(contig, beg, end)
+        else:
+            chunks = [(self._first, float('inf'))]
+        last = -1
+        for start, stop in chunks:
+            self._reader.seek(max(start, last))
+            while self._reader.tell() < stop:
+                offset = self._reader.tell()
+                record = self._read_alignment(tid, end)
+                if record is None:
+                    break
+                ref_id, pos, alignment = record
+                # The alignments are sorted by contig and position
+                if (ref_id > tid or ref_id == -1 or
+                        (ref_id == tid and pos >= end)):
+                    return
+                if alignment is not None and alignment.end > beg and \
+                   offset > last:
+                    last = offset
+                    yield alignment
+
+    def close(self):
+        self._reader.close()
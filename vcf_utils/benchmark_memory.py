@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+"""
+Title: benchmark_memory
+Date: 18-10-2026
+
+Measure the memory held by NormalisedVcf.variants, in bytes per record, on a
+synthetic germline vcf. The resident memory is read from /proc (Linux), use
+--tracemalloc for an exact (but much slower) count of the allocations
+With --baseline, the same vcf is also measured with the vcf_utils directory
+of another tree (e.g. a git worktree of an earlier commit), each tree in its
+own process, for a before / after comparison
+
+Example:
+benchmark_memory.py
+  --records 5000000
+  --columns 'AD','DP','GT','AF'
+  --baseline ../../scripts-baseline/vcf_utils
+"""
+
+import os
+import gc
+import sys
+import random
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+###############################################################################
+
+HEADER_LINES = ['##fileformat=VCFv4.2\n',
+                '##source=benchmark\n',
+                '##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n',
+                '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele \
+count">\n',
+                '##INFO=<ID=AN,Number=1,Type=Integer,Description="Allele \
+number">\n',
+                '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+                '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic \
+depths">\n',
+                '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">\n',
+                '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype \
+quality">\n',
+                '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n']
+
+
+def write_synthetic_vcf(vcf, records):
+    """Write a sorted germline vcf of SNVs and short indels on 24 contigs
+    """
+    random.seed(0)
+    contigs = ['chr{}'.format(i) for i in list(range(1, 23)) + ['X', 'Y']]
+    per_contig = records // len(contigs) + 1
+    with open(vcf, 'w') as f:
+        f.writelines(HEADER_LINES)
+        n = 0
+        for contig in contigs:
+            pos = 0
+            for _ in range(min(per_contig, records - n)):
+                pos += random.randint(1, 600)
+                ref = random.choice('ACGT')
+                alt = random.choice(['A', 'C', 'G', 'T', ref + 'T', ref + 'GA'])
+                dp = random.randint(10, 300)
+                ad = random.randint(0, dp)
+                f.write('{}\t{}\t.\t{}\t{}\t{}\tPASS\tAC=1;AN=2;DP={}\t'
+                        'GT:AD:DP:GQ\t0/1:{},{}:{}:99\n'.format(
+                            contig, pos, ref, alt, random.randint(10, 999),
+                            dp, dp - ad, ad, dp))
+                n += 1
+
+
+
+def resident_memory():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(vcf_name, columns, use_tracemalloc=False):
+    """Number of records and bytes held by NormalisedVcf.variants
+    """
+    from normalisedvcf import NormalisedVcf
+    gc.collect()
+    if use_tracemalloc:
+        tracemalloc.start()
+    else:
+        start = resident_memory()
+    vcf = NormalisedVcf(vcf_name).process_vcf(columns)
+    gc.collect()
+    if use_tracemalloc:
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        used = resident_memory() - start
+    return len(vcf.variants), used
+
+
+def measure_tree(tree, vcf_name):
+    """Run this script on the vcf with the vcf_utils directory tree, output
+    its number of records and bytes
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--vcf', vcf_name,
+               '--columns', args.columns, '--tree', tree]
+    if args.tracemalloc:
+        command.append('--tracemalloc')
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    records, used = output.split()
+    return int(records), int(used)
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description="Memory per record of \
+                                 NormalisedVcf.variants")
+parser.add_argument("--records", help="number of synthetic records \
+                    (default: 5000000)", type=int, default=5000000)
+parser.add_argument("--columns", help="A list of columns, seperated by ','",
+                    default="AD,DP,GT,AF")
+parser.add_argument("--tracemalloc", help="count the allocations with \
+                    tracemalloc instead of the resident memory",
+                    action="store_true")
+parser.add_argument("--baseline", help="vcf_utils directory of a tree to \
+                    compare with")
+parser.add_argument("--vcf", help="measure this vcf instead of a synthetic \
+                    one")
+# Measure with the modules of this vcf_utils directory, and output the number
+# of records and bytes only (the runs of --baseline)
+parser.add_argument("--tree", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if args.tree:
+    sys.path.insert(0, os.path.abspath(args.tree))
+    print(*measure(args.vcf, args.columns.split(','), args.tracemalloc))
+    sys.exit(0)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    vcf_name = args.vcf
+    if vcf_name is None:
+        vcf_name = os.path.join(tmp_dir, 'synthetic.vcf')
+        write_synthetic_vcf(vcf_name, args.records)
+    if args.baseline:
+        trees = [('Baseline', args.baseline),
+                 ('This tree', os.path.dirname(os.path.abspath(__file__)))]
+        results = [(name,) + measure_tree(tree, vcf_name)
+                   for name, tree in trees]
+    else:
+        results = [('This tree',) + measure(vcf_name, args.columns.split(','),
+                                            args.tracemalloc)]
+
+for name, records, used in results:
+    print("{}: {} records, {:.1f} MB, {:.0f} bytes per record".format(
+        name, records, used / 1e6, used / records))
+if args.baseline:
+    print("Ratio: {:.2f}".format((results[1][2] / results[1][1]) /
+                                 (results[0][2] / results[0][1])))
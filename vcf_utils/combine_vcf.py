@@ -10,8 +10,15 @@ Extract (and normalise) information from input vcfs coming from different
 callers, combine to one vcf, and calcualte mean and standard deviation of AD and DP if specified.
 Works on germline and somatic vcfs.
 Warning: the output vcf is not sorted by chromosome and position, users are advised to use other tools to sort this vcf. (Example: bcftools sort vcf -o sorted_vcf)
+         With --sorted-inputs, the vcfs (sorted in the order of their ##contig lines) are merged as a stream, and the output vcf is sorted
+         With --threads N --by-contig, each process combines one contig (or a group of small contigs), and the output vcf is grouped by contig
+         With --max-memory, unsorted vcfs are sorted in ##contig order in the memory budget (spilling sorted runs to --tmp-dir), then merged as with --sorted-inputs
          Tested on HaplotypeCaller and Mutect2 (gatk 4.0.10.0), strelka (2.9.2) and vardict (1.5.1)
 
+Caller summaries (in the working directory):
+-- Combine_variants_summary.tsv: variants per caller, union and intersection of the combinations of callers
+-- Combine_variants_concordance.tsv: exclusive / intersection / union counts of every combination of callers, in total and by variant class (SNV/INDEL/OTHER, the multi-allelics of mixed classes being OTHER) and VAF bin (from the mean AD)
+
 Notes on how the columns are being parsed:
 -- AD/DP: INFO value overwritten by FORMAT value (if FORMAT value exists), in the process_(somatic_)variant
 -- GT: The only enfored column in FORMAT
@@ -46,11 +53,51 @@ A bug: Currently this script doesn't support output file in a directory that doe
 import os
 import sys
 import argparse
-from collections import OrderedDict, defaultdict as dd, Counter
+from collections import OrderedDict, Counter
 from itertools import combinations
-from normalisedvcf import NormalisedVcf, sort_vcf
-from variant import Variant
+from normalisedvcf import NormalisedVcf, sort_vcf, contig_order, \
+    merge_sorted_vcfs, load_vcfs, group_variants, write_combined_variants, \
+    combine_by_contig
 from vcfheader import STATS_HEADER, SOMATIC_STATS_HEADER, HEADER
+from vcfio import open_vcf, parse_region, read_bed
+
+###############################################################################
+
+def combination_counts(histogram, n_callers):
+    """Count the variants of every combination of callers, from the counts
+    per caller bitmask
+    Output {combination mask: (exclusive, intersection, union)}, where
+    exclusive is only called by all of these callers, intersection is called
+    by all of them (and maybe others), and union by any of them
+    """
+    counts = {}
+    for combination in range(1, 1 << n_callers):
+        counts[combination] = (
+            histogram.get(combination, 0),
+            sum(n for mask, n in histogram.items()
+                if mask & combination == combination),
+            sum(n for mask, n in histogram.items() if mask & combination))
+    return counts
+
+
+def combination_mask(callers_indexes):
+    """Bitmask of a combination of callers indexes
+    """
+    return sum(1 << i for i in callers_indexes)
+
+
+def parse_size(size):
+    """Number of bytes of a size with an optional K/M/G suffix, e.g. '4G'
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        sys.exit("Cannot read the memory size '{}', e.g. 4G or 500M"
+                 .format(size))
 
 ###############################################################################
 
@@ -64,12 +111,15 @@ parser = argparse.ArgumentParser(description="Extracts and combines the \
                                  into one")
 optional = parser._action_groups.pop()
 required = parser.add_argument_group("required arguments")
-required.add_argument("-i",  help="input vcfs, the priority of the vcfs will be \
+required.add_argument("-i",  help="input vcfs (plain or gzip/BGZF compressed), the priority of the vcfs will be \
                       based on the order of the input. This parameter can be \
                       specified more than once", action="append", required=True)
 required.add_argument("--columns", help="A list of columns, seperated by ','",
                       required=True)
-required.add_argument("-o", help="output vcf (unsorted)", required=True)
+required.add_argument("-o", help="output vcf (unsorted, unless \
+                      --sorted-inputs or --max-memory is used). Written in \
+                      BGZF, with a tabix index if sorted, when the name ends \
+                      in .gz", required=True)
 required.add_argument("--type", help="must be either germline or somatic", required=True,
                       choices=recognised_modes)
 parser._action_groups.append(optional)
@@ -81,6 +131,38 @@ required.add_argument("--tumor", help="tumor sample ID, required if inputs are \
                       somatic vcfs", required=False)
 required.add_argument("--priority", help="The priority of the callers, must match \
                       with the callers in the source header, seperated by ','", required=False)
+optional.add_argument("--sorted-inputs", help="the input vcfs are sorted in \
+                      the order of their ##contig lines. Stream the vcfs \
+                      through a k-way merge, in constant memory, and write a \
+                      sorted output", action="store_true")
+optional.add_argument("--threads", help="number of processes used to parse \
+                      and normalise the input vcfs (default: 1). With \
+                      --sorted-inputs or --max-memory, only used with \
+                      --by-contig", type=int, default=1)
+optional.add_argument("--by-contig", help="split the work by contig: each of \
+                      the --threads processes combines one contig (or a group \
+                      of small contigs) across all the vcfs, and the outputs \
+                      are concatenated in contig order. The variants of each \
+                      contig must be grouped together in the input vcfs (or \
+                      be compressed, with a tabix index)",
+                      action="store_true")
+optional.add_argument("--region", help="only combine the variants in the \
+                      region chr:start-end (1-based). Seeks with the .tbi / \
+                      .csi index of compressed vcfs. This parameter can be \
+                      specified more than once", action="append")
+optional.add_argument("--regions-bed", help="only combine the variants in the \
+                      regions of this bed file", required=False)
+optional.add_argument("--max-memory", help="sort the input vcfs in the \
+                      order of their ##contig lines, holding at most this \
+                      much of the vcf lines in memory (e.g. 4G, 500M, shared \
+                      by all the vcfs and processes), and merge them as with \
+                      --sorted-inputs. The sorted runs that do not fit are \
+                      written to --tmp-dir", required=False)
+optional.add_argument("--tmp-dir", help="directory of the temporary files \
+                      (default: the directory of the output vcf)",
+                      required=False)
+optional.add_argument("--keep-tmp", help="do not delete the temporary sorted \
+                      runs of --max-memory", action="store_true")
 args = parser.parse_args()
 
 # Sanity check number of inputs
@@ -108,6 +190,19 @@ if args.priority:
     if len(input_files) != len(args.priority):
         sys.exit("The number of vcfs (%s) does not match with the number of callers in priority (%s)" % (len(input_files), len(args.priority)))
 
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
+
+# The k-way merge of sorted inputs runs in one process, only --by-contig
+# splits it
+if args.threads > 1 and not args.by_contig and \
+        (args.sorted_inputs or args.max_memory):
+    print("Warning: --threads is ignored with --sorted-inputs or --max-memory \
+unless --by-contig is given", file=sys.stderr)
+
+if args.tmp_dir and not os.path.isdir(args.tmp_dir):
+    sys.exit("The temporary directory {} does not exist".format(args.tmp_dir))
+
 if args.type not in recognised_modes:
     sys.exit("The mode '{%s}' was not recognised, must be one of: %s" % (args.type, ", ".join(recognised_modes)))
 
@@ -124,150 +219,158 @@ vcf_type = args.type
 normal_id = args.normal
 tumor_id = args.tumor
 
-###############################################################################
+# Regions to restrict the vcfs to (None for the whole vcfs)
+target_regions = None
+if args.region or args.regions_bed:
+    target_regions = [parse_region(region) for region in args.region or []]
+    if args.regions_bed:
+        target_regions += read_bed(args.regions_bed)
 
-if vcf_type == "germline":
+###############################################################################
 
+somatic = vcf_type == "somatic"
+
+tmp_dir = args.tmp_dir or os.path.dirname(os.path.abspath(vcf_out))
+
+# Read the headers (and the variants, unless streaming sorted inputs,
+# sorting the inputs or combining by contig)
+if args.sorted_inputs or args.by_contig or args.max_memory:
+    vcf_list = []
+    for vcf in vcf_in:
+        if not somatic:
+            vcf_list.append(NormalisedVcf(vcf, target_regions).read_header(
+                            columns_to_keep))
+        else:
+            vcf_list.append(NormalisedVcf(vcf, target_regions)
+                            .read_somatic_header(columns_to_keep, normal_id,
+                                                 tumor_id))
+elif args.threads > 1:
+    # Process the vcfs in parallel
+    vcf_list = load_vcfs(vcf_in, columns_to_keep, args.threads, somatic,
+                         normal_id, tumor_id, target_regions)
+elif not somatic:
     # A list of cleaned vcf with extracted columns
-    vcf_list = [NormalisedVcf(vcf).process_vcf(columns_to_keep) for vcf
-                in vcf_in]
-
-    # Combine the variants into a list
-    combined_variants, variant_to_vcf_dict = [], dd(list)
-    callers = [vcf.caller for vcf in vcf_list]
-
-    if args.priority:
-        if set(callers) != set(args.priority):
-            sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, args.priority)), ', '.join(map(str, callers))))
-
-    # Sort the vcf
-    vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
-
-    for i, vcf in enumerate(vcf_list):
-        combined_variants += list(vcf.variants.keys())
-        # Dictionary that let varaint refer back to vcf
-        for var in vcf.variants.keys():
-            variant_to_vcf_dict[var].append(i)
-
-    # Take the unquie variants, don"t sort them
-    combined_variants = list(set(combined_variants))
-
-    # Take the unquie header lines with preserved order
-    # To do: Do we want to reorder the header lines?
-    #        Protentially contain redundant lines
-    combined_header = []
-    for vcf in vcf_list:
-        combined_header += vcf.meta_info
-
-    # Write the combined vcf
-    with open(vcf_out, "w") as combined_f:
-
-        # Write the meta info and header lines
-        for line in list(OrderedDict.fromkeys(combined_header)):
-            combined_f.write(line)
-        for line in STATS_HEADER:
-            combined_f.write(line)
-        # write the chr\tpos\t... line
-        combined_f.write(vcf_list[0].header)
-
-        # Write the variants
-        for v_key in combined_variants:
-            callers_indexes = variant_to_vcf_dict[v_key]
-            callers_names = [callers[i] for i in callers_indexes]
-            info_dict = OrderedDict()
-            for i in callers_indexes:
-                # Combine the selected information in the dictionary
-                info_dict.update(vcf_list[i].variants[v_key].info)
-            i = callers_indexes[0]
-            combined_variant = Variant.combine_info(
-                               vcf_list[i].variants[v_key], columns_to_keep,
-                               callers_names, info_dict)
-            combined_f.write(Variant.write(combined_variant))
-
+    vcf_list = [NormalisedVcf(vcf, target_regions).process_vcf(
+                columns_to_keep) for vcf in vcf_in]
 else:
-
     # Process each vcf and extract the information from the selected columns
-    vcf_list = [NormalisedVcf(vcf).process_somatic_vcf(columns_to_keep,
-                normal_id, tumor_id) for vcf in vcf_in]
-
-    # Combine the variants into a list
-    combined_variants, variant_to_vcf_dict = [], dd(list)
-    callers = [vcf.caller for vcf in vcf_list]
-
-    if args.priority:
-        if set(callers) != set(args.priority):
-            sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, args.priority)), ', '.join(map(str, callers))))
-
-    # Sort the vcf
-    vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
-
-    for i, vcf in enumerate(vcf_list):
-        combined_variants += list(vcf.variants.keys())
-        # Dictionary that let varaint refer back to vcf
-        for var in vcf.variants.keys():
-            variant_to_vcf_dict[var].append(i)
+    vcf_list = [NormalisedVcf(vcf, target_regions).process_somatic_vcf(
+                columns_to_keep, normal_id, tumor_id) for vcf in vcf_in]
 
-    combined_variants = list(set(combined_variants))
+callers = [vcf.caller for vcf in vcf_list]
 
-    combined_header = []
-    for vcf in vcf_list:
-        combined_header += vcf.meta_info
-
-    # Write the combined vcf
-    with open(vcf_out, "w") as combined_f:
-
-        # Write the meta info and header lines
-        for line in list(OrderedDict.fromkeys(combined_header)):
+if args.priority:
+    if set(callers) != set(args.priority):
+        sys.exit("The callers specified in the argument priority [{0}]are different from the vcfs [{1}]".format(', '.join(map(str, args.priority)), ', '.join(map(str, callers))))
+
+# Sort the vcf
+vcf_list, callers = sort_vcf(args.priority, callers, vcf_list)
+
+# Memory budget of the sort of each vcf (in each process)
+sort = None
+if args.max_memory:
+    workers = args.threads if args.by_contig else 1
+    sort = (max(parse_size(args.max_memory) // (len(vcf_list) * workers), 1),
+            tmp_dir, args.keep_tmp)
+
+if args.by_contig:
+    # Variants are combined in the workers
+    merged_variants = None
+elif args.sorted_inputs or sort:
+    # Variants are combined as they pass through the k-way merge
+    order = contig_order(vcf_list)
+    if sort:
+        for vcf in vcf_list:
+            vcf.sort_variants(order, *sort)
+    merged_variants = merge_sorted_vcfs(vcf_list, order)
+else:
+    merged_variants = group_variants(vcf_list)
+
+# Take the unquie header lines with preserved order
+# To do: Do we want to reorder the header lines?
+#        Protentially contain redundant lines
+combined_header = []
+for vcf in vcf_list:
+    combined_header += vcf.meta_info
+
+# Write the combined vcf
+with open_vcf(vcf_out, "w") as combined_f:
+
+    # Write the meta info and header lines
+    for line in list(OrderedDict.fromkeys(combined_header)):
+        combined_f.write(line)
+    # write the chr\tpos\t... line
+    if not somatic:
+        for line in STATS_HEADER:
             combined_f.write(line)
+        combined_f.write(vcf_list[0].header)
+    else:
         for line in SOMATIC_STATS_HEADER:
             combined_f.write(line)
-        # write the chr\tpos\t... line
         combined_f.write("\t".join([HEADER, normal_id, tumor_id+"\n"]))
 
-        # Write the variants
-        for v_key in combined_variants:
-            callers_indexes = variant_to_vcf_dict[v_key]
-            callers_names = [callers[i] for i in callers_indexes]
-            info_dict = OrderedDict()
-            for i in callers_indexes:
-                info_dict.update(vcf_list[i].variants[v_key].info)
-            if callers_names[0] == 'strelka':
-                i = callers_indexes[-1]
-            else:
-                i = callers_indexes[0]
-            combined_variant = Variant.combine_info(
-                               vcf_list[i].variants[v_key], columns_to_keep,
-                               callers_names, info_dict, somatic=True)
-            combined_f.write(Variant.write(combined_variant, somatic=True))
+    # Write the variants, and the variant location file for samtools pileup
+    loc_f = open(regions, "w") if regions else None
+    if args.by_contig:
+        caller_combinations = combine_by_contig(
+            vcf_list, columns_to_keep, combined_f, loc_f, args.threads,
+            somatic, normal_id, tumor_id, args.sorted_inputs,
+            tmp_dir=tmp_dir, regions=target_regions, sort=sort)
+    else:
+        caller_combinations = write_combined_variants(
+            merged_variants, callers, columns_to_keep, combined_f, loc_f,
+            somatic)
+    if loc_f:
+        loc_f.close()
 
 # Output combine varaints summary count
-# Raw contains all the variants in each of the vcf
-vcf_combintaion_raw = [set(vcf.variants.keys()) for vcf in vcf_list]
 vcf_combintaion=[]
 for i in range(2, len(callers)+1):
         for j in list(combinations(range(len(callers)),i)):
             vcf_combintaion.append(j)
 
+# Histogram of the caller bitmasks (all variant classes and VAF bins)
+mask_histogram = Counter()
+for (mask, _, _), n in caller_combinations.items():
+    mask_histogram[mask] += n
+counts = combination_counts(mask_histogram, len(callers))
+
 with open("Combine_variants_summary.tsv", "w") as f:
     f.write("Caller\tCount\n")
     # Do calculation of the combination
     for i, vcf in enumerate(callers):
-        f.write(vcf + "\t" + str(len(vcf_combintaion_raw[i])) + "\n") 
+        f.write(vcf + "\t" + str(counts[combination_mask([i])][2]) + "\n")
     # Calculate union
     for j in vcf_combintaion:
-        union_variants=set()
-        for caller_index in j:
-            union_variants.update(vcf_combintaion_raw[caller_index])
-        f.write("+".join([callers[c] for c in j]) + "\t" + str(len(union_variants)) + "\n")
+        f.write("+".join([callers[c] for c in j]) + "\t" +
+                str(counts[combination_mask(j)][2]) + "\n")
     # Calculate intersection
     for j in vcf_combintaion:
-        newset = [vcf_combintaion_raw[s] for s in j]
-        intersect_variants=set.intersection(*newset)
-        f.write("-".join([callers[c] for c in j]) + "\t" + str(len(intersect_variants)) + "\n")
-
-
-# Write variant location file for samtools pileup
-if regions:
-    with open(regions, "w") as loc_f:
-        for v_key in combined_variants:
-            loc_f.write("\t".join(v_key.split()[:2]) + "\n")
+        f.write("-".join([callers[c] for c in j]) + "\t" +
+                str(counts[combination_mask(j)][1]) + "\n")
+
+# Output the counts of all the combinations of callers (as in an UpSet plot),
+# in total and split by variant class and VAF bin
+variant_classes = sorted(set(k[1] for k in caller_combinations),
+                         key=["SNV", "INDEL", "OTHER"].index)
+vaf_bins = sorted(set(k[2] for k in caller_combinations),
+                  key=lambda b: float("inf") if b == "NA" else
+                  float(b.split("-")[0]))
+strata = [("all", "all")] + [(c, "all") for c in variant_classes] + \
+         [("all", b) for b in vaf_bins] + \
+         [(c, b) for c in variant_classes for b in vaf_bins]
+
+with open("Combine_variants_concordance.tsv", "w") as f:
+    f.write("Callers\tType\tVAF\tExclusive\tIntersection\tUnion\n")
+    for variant_class, vaf in strata:
+        histogram = Counter()
+        for (mask, k_class, k_vaf), n in caller_combinations.items():
+            if variant_class in ["all", k_class] and vaf in ["all", k_vaf]:
+                histogram[mask] += n
+        if not histogram:
+            continue
+        counts = combination_counts(histogram, len(callers))
+        for combination in range(1, 1 << len(callers)):
+            names = [c for i, c in enumerate(callers) if combination >> i & 1]
+            f.write("\t".join(["-".join(names), variant_class, vaf] +
+                              [str(n) for n in counts[combination]]) + "\n")
@@ -8,47 +8,93 @@ Date: 03-07-2020
 This script
  - Calculate AF value for each variant (both SNVs and INDELs)
  - Make DP for INDELs variant by coping over the value of DPI
+The FORMAT names are located once per distinct FORMAT column
 
 """
-import re
 import argparse
 import sys
-from variant import Variant
+from vcfio import open_vcf, read_header, map_records
 
 AF_HEADER_LINE='##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele \
 Frequency, for each ALT allele, in the same order as listed - Calculated By \
 Bioinformatics Dept">\n'
 
+
+# {(FORMAT column, number of values): (number of names, index of DP, DPI,
+#                                      AD, AF, FORMAT written)}
+FORMAT_LAYOUTS = {}
+
+
+def format_layout(format_, n_values):
+    """Indexes of the FORMAT names used, None if missing, and the FORMAT
+    written (DP copied from DPI, then AF, are added if missing), for a sample
+    with n_values values (the names of the values it drops are dropped)
+    """
+    layout = FORMAT_LAYOUTS.get((format_, n_values))
+    if layout is None:
+        names = format_.split(":")[:n_values]
+        dp, dpi, ad, af = [names.index(name) if name in names else None
+                           for name in ["DP", "DPI", "AD", "AF"]]
+        added = []
+        if dp is None and dpi is not None:
+            added.append("DP")
+        if af is None:
+            added.append("AF")
+        layout = (len(names), dp, dpi, ad, af, ":".join(names + added))
+        FORMAT_LAYOUTS[(format_, n_values)] = layout
+    return layout
+
+
+def add_af(lines):
+    """Calculate the AF of the records (for each ALT allele), as vcf text
+    DP is copied from DPI for the INDELs, AF is '.' if DP is 0 or missing
+    """
+    records = []
+    for line in lines:
+        fields = line.strip().split("\t")
+        values = fields[9].split(":")
+        n_names, dp, dpi, ad, af, format_out = format_layout(fields[8],
+                                                             len(values))
+        del values[n_names:]
+        if dp is not None:
+            depth = values[dp]
+        elif dpi is not None:
+            depth = values[dpi]
+            values.append(depth)
+        else:
+            depth = "."
+        if depth in ("0", ".") or ad is None:
+            freq = "."
+        else:
+            depth = float(depth)
+            freq = ",".join([i if i == "." else str(round(float(i) / depth, 2))
+                             for i in values[ad].split(",")[1:]])
+        if af is None:
+            values.append(freq)
+        else:
+            values[af] = freq
+        fields[8:] = format_out, ":".join(values)
+        records.append("\t".join(fields) + "\n")
+    return "".join(records)
+
+
 parser = argparse.ArgumentParser(description="Calculate AF for strelka germline vcf")
-parser.add_argument("-i", dest="input", help="Input strelka germline vcf", required=True)
-parser.add_argument("-o", dest="output", help="Output vcf", required=True)
+parser.add_argument("-i", dest="input", help="Input strelka germline vcf (plain or gzip/BGZF compressed)", required=True)
+parser.add_argument("-o", dest="output", help="Output vcf, BGZF compressed and tabix indexed if the name ends in .gz", required=True)
+parser.add_argument("--threads", type=int, default=1, help="Number of processes calculating the AF of chunks of records (default: 1)")
 args = parser.parse_args()
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
 
-with open(args.input, "r") as f_vcf, open(args.output, "w") as f_vcf_out:
-    for line in f_vcf:
+with open_vcf(args.output, "w") as f_vcf_out:
+    for line in read_header(args.input):
         # Write the header lines
         if line.startswith("##"):
             f_vcf_out.write(line)
-        elif line.startswith("#"):
+        else:
             f_vcf_out.write(AF_HEADER_LINE)
             f_vcf_out.write(line)
 
-        # Calcualte AF for strelka variants
-        else:
-            variant = Variant().read_variant(line)
-            if "DP" in variant.format.keys():
-                if variant.format["DP"] == "0":
-                    variant.format["AF"] = "."
-                else:
-                    variant.format["AF"] = ",".join([
-                        str(round(float(i) / float(variant.format["DP"]), 2))
-                        for i in variant.format["AD"].split(",")[1:]])
-            else:
-                variant.format["DP"] = variant.format["DPI"]
-                if variant.format["DPI"] == "0":
-                    variant.format["AF"] = "."
-                else:
-                    variant.format["AF"] = ",".join([
-                        str(round(float(i) / float(variant.format["DPI"]), 2))
-                        for i in variant.format["AD"].split(",")[1:]])
-            f_vcf_out.write(variant.write())
+    # Calcualte AF for strelka variants
+    for text in map_records(args.input, add_af, threads=args.threads):
+        f_vcf_out.write(text)
@@ -6,15 +6,16 @@ Author: Jiaan Yu
 Date: 07-07-2020
 
 This script
- - Extract and calculate AD and AF value for each variant (both SNVs and INDELs)
+ - Extract and calculate AD and AF value for each variant (both SNVs and INDELs),
+   for each ALT allele of the multi-allelic variants
+The FORMAT names are located once per distinct FORMAT column
 Based on https://github.com/Illumina/strelka/blob/v2.9.x/docs/userGuide/README.md#somatic
 
 
 """
-import re
 import argparse
 import sys
-from variant import Variant
+from vcfio import open_vcf, read_header, map_records
 
 AD_HEADER_LINE='##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Extracted allelic \
 depths for the ref and alt alleles based on strelka recommendation \
@@ -23,43 +24,134 @@ AF_HEADER_LINE='##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele \
 Frequency, for each ALT allele, in the same order as listed - Calculated By \
 Bioinformatics Dept">\n'
 
+
+# {(FORMAT column, number of values): (number of names, index of AD, AF,
+#     FORMAT written, {allele shape: indexes of the allele counts})}
+FORMAT_LAYOUTS = {}
+
+
+def format_layout(format_, n_values):
+    """Indexes of the FORMAT names used, None if missing, and the FORMAT
+    written (AD then AF are added if missing), for a sample with n_values
+    values (the names of the values it drops are dropped)
+    """
+    layout = FORMAT_LAYOUTS.get((format_, n_values))
+    if layout is None:
+        names = format_.split(":")[:n_values]
+        ad, af = [names.index(name) if name in names else None
+                  for name in ["AD", "AF"]]
+        added = [name for name, i in [("AD", ad), ("AF", af)] if i is None]
+        layout = (len(names), ad, af, ":".join(names + added), {})
+        FORMAT_LAYOUTS[(format_, n_values)] = layout
+    return layout
+
+
+def allele_shape(ref, alt, n_alts):
+    """Key of the allele counts of a record: (REF, ALT) for SNVs (a bounded
+    set of bases), the number of ALT alleles for INDELs
+    """
+    if len(ref) == 1 and len(alt) == 2 * n_alts - 1:
+        return ref, alt
+    return n_alts
+
+
+def allele_indexes(format_, n_values, shape):
+    """Indexes of the FORMAT values holding the counts of REF and each ALT
+    allele ({base}U of SNVs, TAR and TIR of INDELs), None if missing (for
+    each allele of a multi-allelic INDEL, TIR not being split by allele)
+    """
+    names = format_.split(":")[:n_values]
+    if isinstance(shape, tuple):
+        alleles = [allele + "U" for allele in [shape[0]] + shape[1].split(",")]
+    elif shape == 1:
+        alleles = ["TAR", "TIR"]
+    else:
+        alleles = ["TAR"] + [None] * shape
+    return [names.index(name) if name in names else None
+            for name in alleles]
+
+
+def tier1_count(values, i):
+    """The tier 1 count of a FORMAT value, None if missing
+    """
+    if i is None or values[i] == ".":
+        return None
+    return int(values[i].split(",")[0])
+
+
+def add_ad_af(lines, normal_index, tumor_index):
+    """Extract the AD and calculate the AF of the records, as vcf text
+    AD holds the tier 1 counts of REF and each ALT allele, AF the frequency
+    of each ALT allele in the sum of the counts ('.' if a count is missing)
+    """
+    records = []
+    for line in lines:
+        fields = line.strip().split("\t")
+        n_alts = fields[4].count(",") + 1
+        shape = allele_shape(fields[3], fields[4], n_alts)
+        formats, samples = [], []
+        for index in [normal_index, tumor_index]:
+            values = fields[index].split(":")
+            n_names, ad, af, format_out, alleles = format_layout(
+                fields[8], len(values))
+            del values[n_names:]
+            formats.append(format_out)
+            indexes = alleles.get(shape)
+            if indexes is None:
+                indexes = allele_indexes(fields[8], len(values), shape)
+                alleles[shape] = indexes
+            try:
+                counts = [int(values[i].split(",", 1)[0]) for i in indexes]
+            except (TypeError, ValueError):
+                counts = [tier1_count(values, i) for i in indexes]
+            if None in counts:
+                ad_value = ",".join(["." if count is None else str(count)
+                                     for count in counts])
+                af_value = ",".join(["."] * n_alts)
+            else:
+                ad_value = ",".join(map(str, counts))
+                total = sum(counts)
+                if total != 0:
+                    total = float(total)
+                    af_value = ",".join([str(round(count / total, 2))
+                                         for count in counts[1:]])
+                else:
+                    af_value = ",".join(["0.00"] * n_alts)
+            if ad is None:
+                values.append(ad_value)
+            else:
+                values[ad] = ad_value
+            if af is None:
+                values.append(af_value)
+            else:
+                values[af] = af_value
+            samples.append(":".join(values))
+        # The FORMAT written is the one of the normal
+        fields[8:] = formats[:1] + samples
+        records.append("\t".join(fields) + "\n")
+    return "".join(records)
+
+
 parser = argparse.ArgumentParser(description="Calculate AF for strelka somatic vcf")
-parser.add_argument("-i", dest="input", help="Input strelka somatic vcf", required=True)
-parser.add_argument("-o", dest="output", help="Output vcf", required=True)
+parser.add_argument("-i", dest="input", help="Input strelka somatic vcf (plain or gzip/BGZF compressed)", required=True)
+parser.add_argument("-o", dest="output", help="Output vcf, BGZF compressed and tabix indexed if the name ends in .gz", required=True)
+parser.add_argument("--threads", type=int, default=1, help="Number of processes calculating the AD and AF of chunks of records (default: 1)")
 args = parser.parse_args()
+if args.threads < 1:
+    sys.exit("The number of threads must be at least 1")
 
-with open(args.input, "r") as f_vcf, open(args.output, "w") as f_vcf_out:
-    for line in f_vcf:
+with open_vcf(args.output, "w") as f_vcf_out:
+    for line in read_header(args.input):
         # Write the header lines
         if line.startswith("##"):
             f_vcf_out.write(line)
-        elif line.startswith("#"):
+        else:
             f_vcf_out.write(AD_HEADER_LINE)
             f_vcf_out.write(AF_HEADER_LINE)
             f_vcf_out.write(line)
             normal_index, tumor_index = (line.split().index("NORMAL"),
                                          line.split().index("TUMOR"))
 
-        else:
-            variant = Variant().process_somatic_variant(line, "strelka",
-                                                        normal_index, tumor_index)
-            # Raise expection for multi-allelic variants
-            if "," in variant.ref or "," in variant.alt:
-                print("The following varinat is a multi-allelic variant:\n" +
-                      variant.write())
-                sys.exit(0)
-
-            else:
-                for vtype in ['normal', 'tumor']:
-                    if len(variant.ref) == len(variant.alt) == 1:
-                        refCounts = int(variant.format[vtype][variant.ref+"U"].split(",")[0])
-                        altCounts = int(variant.format[vtype][variant.alt+"U"].split(",")[0])
-                    else:
-                        refCounts = int(variant.format[vtype]["TAR"].split(",")[0])
-                        altCounts = int(variant.format[vtype]["TIR"].split(",")[0])
-                    variant.format[vtype]["AD"] = str(refCounts) + "," + str(altCounts)
-                    if refCounts + altCounts != 0:
-                        variant.format[vtype]["AF"] = str(round(altCounts / float(refCounts + altCounts), 2))
-                    else:
-                        variant.format[vtype]["AF"] = "0.00"
-                f_vcf_out.write(variant.write(somatic=True))
+    for text in map_records(args.input, add_ad_af,
+                            (normal_index, tumor_index), args.threads):
+        f_vcf_out.write(text)
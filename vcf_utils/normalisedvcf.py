@@ -1,13 +1,24 @@
+import os
 import sys
-from collections import OrderedDict as od
+import heapq
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict as od, defaultdict as dd, Counter
+from itertools import groupby
 from vcfheader import VcfHeader, extract_cols, extract_cols_somatic
-from variant import Variant
+from variant import Variant, ColumnDecoder
+from vcfio import open_vcf, is_compressed, find_index, fetch, \
+    filter_regions, external_sort, header_contigs, TabixIndex, MAX_POS
 
 ##############################################################################
 
 AF_LINE = '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency, \
 for each ALT allele, in the same order as listed">'
 
+# Upper bounds of the allele frequency bins in the caller summary
+VAF_BINS = [0.05, 0.1, 0.25, 0.5, 0.75, 1.0]
+
 ##############################################################################
 
 
@@ -35,6 +46,295 @@ from the vcfs".format(' '.join(priority), ' '.join(callers)))
         callers = sorted(callers, key=lambda caller: caller.lower())
     return vcf_list, callers
 
+
+
+def _load_vcf(job):
+    """Process one vcf in a worker, and return it packed
+    """
+    vcfname, cols, somatic, nid, tid, regions = job
+    if not somatic:
+        vcf = NormalisedVcf(vcfname, regions).process_vcf(cols)
+    else:
+        vcf = NormalisedVcf(vcfname, regions).process_somatic_vcf(cols, nid,
+                                                                  tid)
+    return vcf.pack()
+
+
+def load_vcfs(vcf_names, cols, threads=1, somatic=False, nid=None, tid=None,
+              regions=None):
+    """Process the vcfs in a pool of 'threads' processes
+    Output a list of NormalisedVcf, in the order of vcf_names
+    """
+    jobs = [(vcfname, cols, somatic, nid, tid, regions) for vcfname in
+            vcf_names]
+    with ProcessPoolExecutor(max_workers=min(threads, len(jobs))) as pool:
+        return [NormalisedVcf.unpack(packed) for packed in
+                pool.map(_load_vcf, jobs)]
+
+def contig_order(vcf_list):
+    """Rank the contigs by the order of the ##contig lines, taking the vcfs
+    in priority order. Contigs only declared in later vcfs are appended
+    """
+    order = od()
+    for vcf in vcf_list:
+        for contig in vcf.contigs():
+            order.setdefault(contig, len(order))
+    if not order:
+        sys.exit("No ##contig lines found in the vcf headers, these are \
+required to merge sorted vcfs")
+    return order
+
+
+def _position_blocks(vcf, index, order):
+    """Group the variants of a sorted vcf by position
+    Output (contig rank, pos, vcf index, {variant_key: variant}) per position
+    """
+    last, block = None, od()
+    for variant in vcf.iter_variants():
+        try:
+            key = (order[variant.chr], variant.pos)
+        except KeyError:
+            sys.exit("Contig '{}' in file {} is not declared in the ##contig \
+header lines".format(variant.chr, vcf.name))
+        if key != last:
+            if last is not None:
+                if key < last:
+                    sys.exit("File {} is not sorted in ##contig order at \
+{}:{}".format(vcf.name, variant.chr, variant.pos))
+                yield last + (index, block)
+            last, block = key, od()
+        block[variant.variant_key] = variant
+    if last is not None:
+        yield last + (index, block)
+
+
+def merge_sorted_vcfs(vcf_list, order):
+    """k-way merge of sorted vcfs (with headers read), in ##contig order
+    Output a list of (vcf index, variant) per variant_key, with the vcf
+    indexes in ascending order. Only one position per vcf is held in memory
+    """
+    streams = [_position_blocks(vcf, i, order) for i, vcf in
+               enumerate(vcf_list)]
+    merged = heapq.merge(*streams)
+    for _, blocks in groupby(merged, key=lambda block: block[:2]):
+        variants = od()
+        for _, _, i, block in blocks:
+            for v_key, variant in block.items():
+                variants.setdefault(v_key, []).append((i, variant))
+        for v_key in variants:
+            yield variants[v_key]
+
+
+
+def group_variants(vcf_list):
+    """Group the variants of the processed vcfs by variant_key (unsorted)
+    Output a list of (vcf index, variant) per variant_key, with the vcf
+    indexes in ascending order
+    """
+    # Combine the variants into a list
+    combined_variants, variant_to_vcf_dict = [], dd(list)
+    for i, vcf in enumerate(vcf_list):
+        combined_variants += list(vcf.variants.keys())
+        # Dictionary that let varaint refer back to vcf
+        for var in vcf.variants.keys():
+            variant_to_vcf_dict[var].append(i)
+
+    # Take the unquie variants, don"t sort them
+    combined_variants = list(set(combined_variants))
+    for v_key in combined_variants:
+        yield [(i, vcf_list[i].variants[v_key]) for i in
+               variant_to_vcf_dict[v_key]]
+
+
+def combine_variants(vcf_variants, callers, cols, somatic=False):
+    """Combine the records of one variant_key from the vcfs
+    Input: a list of (vcf index, variant), in priority order
+    Output: the combined variant object
+    """
+    callers_names = [callers[i] for i, _ in vcf_variants]
+    info_dict = od()
+    for _, variant in vcf_variants:
+        # Combine the selected information in the dictionary
+        info_dict.update(variant.info)
+    if somatic and callers_names[0] == 'strelka':
+        variant = vcf_variants[-1][1]
+    else:
+        variant = vcf_variants[0][1]
+    return Variant.combine_info(variant, cols, callers_names, info_dict,
+                                somatic=somatic)
+
+
+def vaf_bin(vaf):
+    """Label of the VAF_BINS bin of an allele frequency
+    """
+    if vaf is None:
+        return 'NA'
+    lower = 0
+    for upper in VAF_BINS:
+        if vaf < upper or upper == VAF_BINS[-1]:
+            return '{}-{}'.format(lower, upper)
+        lower = upper
+
+
+def write_combined_variants(merged_variants, callers, cols, vcf_f,
+                            loc_f=None, somatic=False):
+    """Combine and write the grouped variants (from group_variants or
+    merge_sorted_vcfs), and their locations for samtools mpileup
+    Output the count of variants per (caller bitmask, variant class, VAF bin),
+    bit i of the mask being set if callers[i] called the variant
+    """
+    caller_combinations = Counter()
+    for vcf_variants in merged_variants:
+        combined_variant = combine_variants(vcf_variants, callers, cols,
+                                            somatic)
+        vcf_f.write(Variant.write(combined_variant, somatic=somatic))
+        mask = 0
+        for i, _ in vcf_variants:
+            mask |= 1 << i
+        caller_combinations[(mask, combined_variant.variant_class(),
+                             vaf_bin(combined_variant.allele_frequency(
+                                 somatic)))] += 1
+        # Write variant location file for samtools pileup
+        if loc_f is not None:
+            loc_f.write('\t'.join([combined_variant.chr,
+                                   str(combined_variant.pos)]) + '\n')
+    return caller_combinations
+
+
+def _contig_ranges(vcfname):
+    return NormalisedVcf(vcfname).contig_ranges()
+
+
+def _combine_shard(job):
+    """Combine the variants of one shard of contigs, in a worker
+    """
+    (vcf_names, cols, somatic, nid, tid, shard_ranges, shard_regions,
+     sorted_inputs, sort, vcf_name, loc_name) = job
+    vcf_list = []
+    for vcfname, ranges, regions in zip(vcf_names, shard_ranges,
+                                        shard_regions):
+        vcf = NormalisedVcf(vcfname, regions)
+        if not somatic:
+            vcf.read_header(cols)
+        else:
+            vcf.read_somatic_header(cols, nid, tid)
+        vcf.ranges = ranges
+        if not (sorted_inputs or sort):
+            vcf.load_variants()
+        vcf_list.append(vcf)
+    callers = [vcf.caller for vcf in vcf_list]
+
+    if sort:
+        order = contig_order(vcf_list)
+        for vcf in vcf_list:
+            vcf.sort_variants(order, *sort)
+    if sorted_inputs or sort:
+        merged_variants = merge_sorted_vcfs(vcf_list, contig_order(vcf_list))
+    else:
+        merged_variants = group_variants(vcf_list)
+    with open(vcf_name, 'w') as vcf_f, open(loc_name, 'w') as loc_f:
+        return write_combined_variants(merged_variants, callers, cols, vcf_f,
+                                       loc_f, somatic)
+
+
+def combine_by_contig(vcf_list, cols, vcf_f, loc_f=None, threads=1,
+                      somatic=False, nid=None, tid=None, sorted_inputs=False,
+                      tmp_dir=None, regions=None, sort=None):
+    """Combine the vcfs (with headers read, in priority order) in shards of
+    contigs, one shard per worker. Compressed vcfs are read by contig with
+    their tabix index, otherwise each contig must be in one block of lines.
+    The variants of each shard are sorted with the (max_memory, tmp_dir,
+    keep) of sort, if given. The shard outputs are concatenated in contig
+    order
+    Output the count of variants per combination of callers
+    """
+    vcf_names = [vcf.name for vcf in vcf_list]
+    for vcf in vcf_list:
+        vcf._vcf.close()
+
+    with ProcessPoolExecutor(max_workers=threads) as pool, \
+            tempfile.TemporaryDirectory(dir=tmp_dir) as shard_dir:
+        vcf_ranges = list(pool.map(_contig_ranges, vcf_names))
+        indexed = [vcf_range is None for vcf_range in vcf_ranges]
+        for i, vcfname in enumerate(vcf_names):
+            if indexed[i]:
+                # Size of the contigs from the compressed offsets
+                index = TabixIndex(find_index(vcfname))
+                vcf_ranges[i] = od()
+                for contig in index.contigs:
+                    start, end = index.span(contig)
+                    vcf_ranges[i][contig] = (start >> 16, (end >> 16) + 1)
+
+        # Contigs in ##contig order, then any undeclared contigs
+        contigs = od((contig, 0) for vcf in vcf_list
+                     for contig in vcf.contigs())
+        for ranges in vcf_ranges:
+            for contig, (start, end) in ranges.items():
+                contigs[contig] = contigs.get(contig, 0) + end - start
+        if regions is not None:
+            region_contigs = set(r[0] for r in regions)
+            contigs = od((k, v) for k, v in contigs.items()
+                         if k in region_contigs)
+        contigs = od((k, v) for k, v in contigs.items() if v)
+
+        # Large contigs get their own shard, and consecutive small contigs
+        # are grouped up to the same size
+        shard_size = sum(contigs.values()) / (threads * 4)
+        shards, size = [], shard_size
+        for contig, contig_size in contigs.items():
+            if size >= shard_size:
+                shards.append([])
+                size = 0
+            shards[-1].append(contig)
+            size += contig_size
+
+        futures = []
+        for n, shard in enumerate(shards):
+            if regions is not None:
+                shard_regions = [r for r in regions if r[0] in shard]
+            else:
+                shard_regions = [(contig, 0, MAX_POS) for contig in shard]
+            # Indexed vcfs are read by region, the others by byte range
+            # (filtered by the regions, if any)
+            vcf_shard_ranges, vcf_shard_regions = [], []
+            for i, ranges in enumerate(vcf_ranges):
+                if indexed[i]:
+                    vcf_shard_ranges.append(None)
+                    vcf_shard_regions.append(shard_regions)
+                else:
+                    vcf_shard_ranges.append([ranges[contig] for contig in
+                                             shard if contig in ranges])
+                    vcf_shard_regions.append(
+                        shard_regions if regions is not None else None)
+            shard_names = [os.path.join(shard_dir, '{}.{}'.format(n, ext))
+                           for ext in ['vcf', 'tsv']]
+            futures.append(pool.submit(_combine_shard, (
+                vcf_names, cols, somatic, nid, tid, vcf_shard_ranges,
+                vcf_shard_regions, sorted_inputs, sort, *shard_names)))
+
+        caller_combinations = Counter()
+        for n, future in enumerate(futures):
+            caller_combinations.update(future.result())
+            with open(os.path.join(shard_dir, '{}.vcf'.format(n))) as f:
+                shutil.copyfileobj(f, vcf_f)
+            if loc_f is not None:
+                with open(os.path.join(shard_dir, '{}.tsv'.format(n))) as f:
+                    shutil.copyfileobj(f, loc_f)
+    return caller_combinations
+
+
+def _read_ranges(vcfname, ranges):
+    """Read the lines in the byte ranges [(start, end)] of a file
+    """
+    with open(vcfname, 'rb') as vcf:
+        for start, end in ranges:
+            vcf.seek(start)
+            for line in vcf:
+                if start >= end:
+                    break
+                start += len(line)
+                yield line.decode()
+
 ##############################################################################
 
 
@@ -46,23 +346,58 @@ class NormalisedVcf:
     meta_info: meta info lines (list)
     header: #CHROM\t.... (string)
     variants: variant objects query by 'CHROM_POS_ID_REF_ALF' (dictionary)
+    ranges: byte ranges [(start, end)] of the variant lines to read, or None
+            to read the whole file
+    regions: only read the variants overlapping the regions
+             [(contig, beg, end)] (0-based, half-open), or None
     """
 
-    def __init__(self, vcfname):
+    def __init__(self, vcfname, regions=None):
         self.name = vcfname
+        self.regions = regions
         self.caller = ''
         self.meta_info = []
         self.header = ''
         self.variants = {}
+        self.ranges = None
+        self._sort = None
+
+    def pack(self):
+        """Compact tuple of the processed vcf, to pass between processes
+        """
+        return (self.name, self.caller, self.meta_info, self.header,
+                self._somatic, [variant.pack(self._somatic) for variant in
+                                self.variants.values()])
+
+    @classmethod
+    def unpack(cls, packed):
+        """Create the processed vcf from the tuple of NormalisedVcf.pack
+        """
+        name, caller, meta_info, header, somatic, variants = packed
+        vcf = cls(name)
+        vcf.caller, vcf.meta_info, vcf.header = caller, meta_info, header
+        vcf._somatic = somatic
+        for packed_variant in variants:
+            variant = Variant.unpack(packed_variant, somatic)
+            vcf.variants[variant.variant_key] = variant
+        return vcf
 
     def process_vcf(self, cols):
         """Build object from vcf
         """
-        vcf = open(self.name, 'r')
+        self.read_header(cols)
+        return self.load_variants()
+
+    def read_header(self, cols):
+        """Read the meta-information and header lines of a germline vcf, and
+        select the INFO/FORMAT columns. The file is left open at the first
+        variant, ready for iter_variants
+        """
+        vcf = open_vcf(self.name)
         info_dict, format_dict = {}, {}
 
         # Read the meta-information lines from the vcf
-        for i, line in enumerate(vcf):
+        for line in vcf:
             # Handle exceptions: the AF will be calcualted regardless;
             if line.startswith('##FORMAT=<ID=AF'):
                 pass
@@ -104,27 +439,30 @@ class NormalisedVcf:
         self.meta_info += [VcfHeader.write(v) for k, v in format_cols.items()]
 
         self.header = line
-
-        # Continue to read the file, this time the variants
-        for j, line in enumerate(vcf):
-            variant = Variant().process_variant(line, caller=self.caller)
-            if variant.alt == '*':
-                print("Warning: Vcf {} line {} has variant with alt=*".format(self.caller, str(i+j+1)))
-            cleaned_variant = Variant.select_info(variant, info_cols, format_cols)
-            # The dictionary is query by chr\tpos\tref\talt
-            self.variants.update({cleaned_variant.variant_key: cleaned_variant})
+        self._vcf = vcf
+        self._info_cols, self._format_cols = info_cols, format_cols
+        self._somatic = False
+        self._decoder = ColumnDecoder(info_cols, format_cols, self.caller)
 
         return self
 
     def process_somatic_vcf(self, cols, nid, tid):
         """Process somatic vcf, with normal and tumor sample id provided
         """
+        self.read_somatic_header(cols, nid, tid)
+        return self.load_variants()
 
-        vcf = open(self.name, 'r')
+    def read_somatic_header(self, cols, nid, tid):
+        """Read the header lines of a somatic vcf, select the INFO/FORMAT
+        columns and locate the normal / tumor samples. The file is left open
+        at the first variant, ready for iter_variants
+        """
+
+        vcf = open_vcf(self.name)
         info_dict, format_dict = od(), od()
 
         # Read the meta-information lines from the vcf
-        for i, line in enumerate(vcf):
+        for line in vcf:
             # Handle exceptions: skip the AF and DP in INFO
             if (line.startswith('##INFO=<ID=DP') or
                line.startswith('##INFO=<ID=AF')):
@@ -174,17 +512,96 @@ class NormalisedVcf:
             sys.exit("Normal sample id [{}] or tumor sample id [{}] didn't match with file {}: [{}], [{}]"
                      .format(nid, tid, self.name, self.header.split()[9], self.header.split()[10]))
 
-        # Continue to read the file, this time the variants
-        for j, line in enumerate(vcf):
-            variant = Variant().process_somatic_variant(
-                    line, self.caller, normal_index, tumor_index)
-            if variant.alt == '*':
-                print("Warning: Line {} contains variant with alt=*".format(str(i+j+1)))
-            cleaned_variant = Variant.select_info(variant, info_cols, format_cols,
-                                                  caller=self.caller, somatic=True)
+        self._vcf = vcf
+        self._info_cols, self._format_cols = info_cols, format_cols
+        self._somatic = True
+        self._normal_index, self._tumor_index = normal_index, tumor_index
+        self._decoder = ColumnDecoder(info_cols, format_cols, self.caller,
+                                      True, normal_index, tumor_index)
+
+        return self
+
+    def load_variants(self):
+        """Read the variants into the dictionary, after read_header /
+        read_somatic_header
+        """
+        for variant in self.iter_variants():
             # The dictionary is query by chr\tpos\tref\talt
-            self.variants.update({cleaned_variant.variant_key: cleaned_variant})
+            self.variants.update({variant.variant_key: variant})
 
         return self
 
+    def iter_variants(self):
+        """Continue to read the file after read_header / read_somatic_header,
+        and yield the cleaned variants one at a time (only the lines in
+        self.ranges and / or self.regions, if set)
+        """
+        with self._vcf as vcf:
+            if self.ranges is not None:
+                vcf = _read_ranges(self.name, self.ranges)
+                if self.regions is not None:
+                    vcf = filter_regions(vcf, self.regions)
+            elif self.regions is not None:
+                vcf = fetch(self.name, self.regions)
+            if self._sort is not None:
+                vcf = external_sort(vcf, self._sort_key, *self._sort[1:])
+            for line in vcf:
+                # Only the selected columns are decoded
+                variant = self._decoder.decode(line)
+                # Located by position, the lines being read by ranges,
+                # regions or sorted
+                if variant.alt == '*':
+                    if not self._somatic:
+                        print("Warning: Vcf {} has variant with alt=* at {}:{}".format(self.caller, variant.chr, variant.pos))
+                    else:
+                        print("Warning: Variant at {}:{} contains alt=*".format(variant.chr, variant.pos))
+                yield variant
+
+    def sort_variants(self, order, max_memory, tmp_dir=None, keep=False):
+        """Sort the variants of iter_variants in the contig order
+        {contig: rank} (from contig_order), holding at most max_memory bytes
+        of lines and spilling sorted runs to tmp_dir (see external_sort)
+        """
+        self._sort = (order, max_memory, tmp_dir, keep)
+        return self
 
+    def _sort_key(self, line):
+        contig, pos = line.split('\t', 2)[:2]
+        try:
+            return (self._sort[0][contig], int(pos))
+        except KeyError:
+            sys.exit("Contig '{}' in file {} is not declared in the ##contig \
+header lines".format(contig, self.name))
+
+    def contigs(self):
+        """Return the contig names declared in the ##contig lines, in
+        header order
+        """
+        return header_contigs(self.meta_info)
+
+    def contig_ranges(self):
+        """Scan the variant lines for the byte range of each contig
+        Output {contig: (start, end)}, the variants must be grouped by contig.
+        None for compressed vcfs, which must have a tabix index instead
+        """
+        if is_compressed(self.name):
+            if find_index(self.name) is None:
+                sys.exit("File {} is compressed but has no .tbi / .csi \
+index, which is required to split it by contig".format(self.name))
+            return None
+        ranges, contig, start, offset = od(), None, 0, 0
+        with open(self.name, 'rb') as vcf:
+            for line in vcf:
+                if not line.startswith(b'#'):
+                    line_contig = line.split(b'\t', 1)[0].decode()
+                    if line_contig != contig:
+                        if contig is not None:
+                            ranges[contig] = (start, offset)
+                        if line_contig in ranges:
+                            sys.exit("The variants of contig '{}' in file {} \
+are not grouped together".format(line_contig, self.name))
+                        contig, start = line_contig, offset
+                offset += len(line)
+        if contig is not None:
+            ranges[contig] = (start, offset)
+        return ranges
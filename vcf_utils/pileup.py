@@ -0,0 +1,830 @@
+"""
+Pileups of samtools mpileup files or BAM files, for add_bam_stats
+
+A pileup source returns the pileup record [depth, counts] of a position with
+get(contig, pos, ref, sample), or '' if the position is not in the mpileup
+(counts is the PileupCounts table of the bases column, ref the REF of the
+record, sample the index of the sample in a multi-sample mpileup):
+Mpileups may also be read from the standard input ('-'), or from the output of
+a command as it runs ('samtools mpileup ... |')
+PileupDict reads the whole mpileup (or only the positions in a list of
+regions) into a dictionary first
+PileupStream reads an mpileup sorted in the same contig order as the vcf
+along with it, holding only the current line
+BamPileup counts the reads of an indexed BAM file at the positions, without
+an mpileup
+CountStore looks the positions up in the binary counts of an mpileup, written
+once by write_count_store (memory-mapped, no text parsing)
+All keep the counts of the last positions asked for in a PileupCache, shared
+by all the records at a site (split multi-allelics, or several callers)
+"""
+
+import gzip
+import io
+import os
+import re
+import mmap
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from itertools import compress
+from vcfio import open_vcf, fetch, filter_regions, merge_regions, \
+    PILEUP_CONF
+from bam import BamFile, CIGAR_INS, CIGAR_DEL, CIGAR_REF_SKIP, BAM_FREVERSE, \
+    BAM_FUNMAP, BAM_FSECONDARY, BAM_FQCFAIL, BAM_FDUP
+
+##############################################################################
+
+# Read starts (with their mapping quality), read ends and indels (followed by
+# their length) in the bases column
+PILEUP_TOKEN = re.compile(r'\^.|\$|[+-][0-9]+')
+
+# Number of positions whose pileup records are cached
+PILEUP_CACHE_SIZE = 1024
+
+# samtools mpileup settings of the BAM pileups: -d (maximum number of reads
+# per position), and the reads skipped (--ff UNMAP,SECONDARY,QCFAIL,DUP).
+# The anomalous read pairs are counted (-A), and no base is skipped (-Q 0)
+MAX_DEPTH = 10000
+SKIP_FLAGS = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP
+
+# Length of the reference whose reads are decoded at once from a BAM file
+BAM_WINDOW = 1 << 14
+
+# Binary count store of an mpileup (name + COUNT_STORE_EXT): a row of uint32
+# per position (position, then for each sample the depth, the counts of
+# STORE_BASES and the range of its indels), the indels (sequence index, count)
+# and their sequences ('+ca', '-CA'), the contigs, and a trailer with the
+# section offsets, the number of samples and the minimum base and mapping
+# qualities of the reads counted
+COUNT_STORE_EXT = '.counts'
+COUNT_STORE_MAGIC = b'PMCCNT1\0'
+STORE_BASES = '.,AaCcGgTt'
+STORE_SAMPLE = len(STORE_BASES) + 3
+STORE_TRAILER = struct.Struct('<QQQIII8s')
+
+# Size of the read buffer of an mpileup pipe (samtools blocks when the pipe is
+# full, until the lines are read)
+PIPE_BUFFER_SIZE = 1 << 20
+
+##############################################################################
+
+
+class PileupCounts:
+    """Counts of the bases column of an mpileup line, read in one pass:
+    bases: {base: count} of the aligned bases ('.' / ',' for the reference,
+    upper / lower case for the forward / reverse strand, '*' / '#' for the
+    deletions)
+    insertions, deletions: {sequence: count} of the indels following the
+    bases, with the case of their strand
+    starts, ends: number of read starts and ends
+    Only the reads whose byte is not 0 in keep (one per base, see
+    QualityFilter) are counted, if given
+    """
+
+    __slots__ = ('bases', '_insertions', '_deletions', 'starts', 'ends')
+
+    def __init__(self, bases='', keep=None):
+        # The indel Counters are created on first use (by the indels only)
+        self._insertions = self._deletions = None
+        self.starts, self.ends = 0, 0
+        # Most lines have no read start, end or indel: only the bases
+        if not ('^' in bases or '$' in bases or '+' in bases or
+                '-' in bases):
+            self.bases = Counter(bases if keep is None else
+                                 compress(bases, keep))
+            return
+        # Plain runs of bases between the tokens, counted all at once, and
+        # the number of bases read
+        runs = []
+        pos, n = 0, 0
+        search = PILEUP_TOKEN.search
+        token = search(bases)
+        while token:
+            start, end = token.span()
+            runs.append(bases[pos:start])
+            n += start - pos
+            token = token.group()
+            # The read start is on the next base, the end and the indels on
+            # the previous one
+            if token[0] == '^':
+                if keep is None or keep[n]:
+                    self.starts += 1
+            elif token == '$':
+                if keep is None or keep[n - 1]:
+                    self.ends += 1
+            else:
+                # Skip over the indel sequence, whose length may be >= 10
+                length = int(token[1:])
+                if keep is None or keep[n - 1]:
+                    indels = self.insertions if token[0] == '+' else \
+                        self.deletions
+                    indels[bases[end:end + length]] += 1
+                end += length
+            pos = end
+            token = search(bases, pos)
+        runs.append(bases[pos:])
+        if keep is None:
+            self.bases = Counter(''.join(runs))
+        else:
+            self.bases = Counter(compress(''.join(runs), keep))
+
+    @property
+    def insertions(self):
+        if self._insertions is None:
+            self._insertions = Counter()
+        return self._insertions
+
+    @property
+    def deletions(self):
+        if self._deletions is None:
+            self._deletions = Counter()
+        return self._deletions
+
+    def strands(self, allele, counter=None):
+        """Forward and reverse counts of a base or indel sequence
+        """
+        counter = self.bases if counter is None else counter
+        return counter[allele.upper()], counter[allele.lower()]
+
+
+def quality_table(min_quality):
+    """bytes.translate table of the phred+33 quality characters to 1 if at
+    least min_quality, 0 otherwise
+    """
+    return bytes(int(char - 33 >= min_quality) for char in range(256))
+
+
+class QualityFilter:
+    """Minimum base and mapping qualities of the reads counted in an mpileup
+    The mapping qualities are read from the column of samtools mpileup
+    -s / --output-MQ (after the base qualities of each sample), needed with
+    min_mapq
+    """
+
+    def __init__(self, min_baseq=0, min_mapq=0):
+        self.min_baseq, self.min_mapq = min_baseq, min_mapq
+        self._baseq = quality_table(min_baseq)
+        self._mapq = quality_table(min_mapq)
+
+    def keep(self, quals, mapqs=None):
+        """Byte per base, 1 to count it and 0 to drop it, from the quality
+        columns. Both are thresholded at once by bytes.translate, and
+        combined as integers
+        """
+        keep = quals.rstrip('\n').encode().translate(self._baseq)
+        if mapqs is not None:
+            mapq = mapqs.rstrip('\n').encode().translate(self._mapq)
+            keep = (int.from_bytes(keep, 'big') & int.from_bytes(mapq, 'big')) \
+                .to_bytes(len(keep), 'big')
+        return keep
+
+
+def sample_columns(fields, quality=None):
+    """Number of columns of each sample of an mpileup, from its first split
+    line: depth, bases, base qualities, and the MAPQ of -s / --output-MQ
+    (required by min_mapq). The readers decide it once per file, for all its
+    lines. The MAPQ column is detected from the layout of the line: when both
+    3 and 4 columns per sample fit, it is there if each sample of 4 columns
+    starts with a depth and has as many base as mapping qualities (the bases
+    of a sample of 3 columns never being a number)
+    """
+    n = len(fields) - 3
+    if n % 4:
+        columns = 3
+    elif n % 3:
+        columns = 4
+    else:
+        columns = 4 if all(
+            fields[i].isdigit() and
+            len(fields[i + 2]) == len(fields[i + 3].rstrip('\n'))
+            for i in range(3, len(fields), 4)) else 3
+    if columns == 3 and quality is not None and quality.min_mapq:
+        sys.exit('--min-mapq requires the mapping qualities of samtools \
+mpileup -s (--output-MQ), missing from the mpileup line at {}:{}'.format(
+            fields[0], fields[1]))
+    return columns
+
+
+def pileup_record(fields, sample=0, quality=None, columns=3):
+    """[depth, counts] of a sample of a split mpileup line of columns per
+    sample (see sample_columns), counting only the reads passing the
+    QualityFilter if given (the depth is then the number of reads counted)
+    """
+    i = columns * sample + 3
+    if quality is None:
+        return [fields[i], PileupCounts(fields[i + 1].rstrip('\n'))]
+    # A sample without coverage has '*' placeholders, not qualities
+    if fields[i] == '0':
+        return ['0', PileupCounts()]
+    keep = quality.keep(fields[i + 2],
+                        fields[i + 3] if quality.min_mapq else None)
+    return [str(keep.count(1)), PileupCounts(fields[i + 1], keep)]
+
+
+class PileupCache:
+    """Least recently used pileup records {position: [depth, counts]}, bounded
+    to size positions. Counts the hits and misses of the lookups
+    """
+
+    def __init__(self, size=PILEUP_CACHE_SIZE):
+        self.size = size
+        self.hits, self.misses = 0, 0
+        self._records = OrderedDict()
+
+    def get(self, key, build, *args):
+        """Record at the position key, built by build(*args) if it is not
+        cached
+        """
+        record = self._records.get(key)
+        if record is not None:
+            self.hits += 1
+            self._records.move_to_end(key)
+            return record
+        self.misses += 1
+        record = self._records[key] = build(*args)
+        if len(self._records) > self.size:
+            self._records.popitem(last=False)
+        return record
+
+    def report(self, name):
+        return "Pileup cache of {}: {} hits, {} misses".format(
+            name, self.hits, self.misses)
+
+
+def is_pipe(mpileup):
+    """Check whether an mpileup is read from the standard input ('-') or from
+    a command ending in '|'
+    """
+    return mpileup == '-' or mpileup.rstrip().endswith('|')
+
+
+def open_mpileup(mpileup):
+    """Open an mpileup file (plain or compressed) or pipe, or exit
+    """
+    if is_pipe(mpileup):
+        return MpileupPipe(mpileup)
+    try:
+        return open_vcf(mpileup)
+    except:
+        sys.exit('Failed to open file {}'.format(mpileup))
+
+
+class MpileupPipe:
+    """The lines of an mpileup read from the standard input ('-'), or from the
+    output of a command ('samtools mpileup ... |') while it runs
+    The command exits with an error if it fails, once its output is read, or
+    is stopped if the lines are no longer needed
+    """
+
+    def __init__(self, mpileup):
+        self.name = mpileup
+        self._process = None
+        if mpileup == '-':
+            stream = sys.stdin.buffer
+        else:
+            self.command = mpileup.rstrip()[:-1].strip()
+            try:
+                self._process = subprocess.Popen(
+                    self.command, shell=True, stdout=subprocess.PIPE,
+                    bufsize=PIPE_BUFFER_SIZE)
+            except OSError:
+                sys.exit('Failed to run command {}'.format(self.command))
+            stream = self._process.stdout
+        # bgzip / gzip output is decompressed too
+        if stream.peek(2)[:2] == b'\x1f\x8b':
+            stream = gzip.GzipFile(fileobj=stream)
+        self._stream = io.TextIOWrapper(stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._stream.readline()
+        if not line:
+            self._check()
+            raise StopIteration
+        return line
+
+    def _check(self):
+        """Exit if the command failed
+        """
+        if self._process is not None and self._process.wait():
+            sys.exit('Command {} failed with exit status {}'.format(
+                self.command, self._process.returncode))
+
+    def close(self):
+        if self._process is None:
+            return
+        # A command still writing lines that are not needed is stopped, and
+        # one that already ended is checked
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        else:
+            self._check()
+        self._process.stdout.close()
+        self._process = None
+
+
+def mpileup_regions(mpileup, f, regions, ranges=None):
+    """The lines of the open mpileup f in the regions: filtered from a pipe,
+    read from the byte ranges {contig: (start, end)} of a plain mpileup if
+    given (see mpileup_contig_ranges), or fetched with the index of a file
+    """
+    if is_pipe(mpileup):
+        return filter_regions(f, regions, PILEUP_CONF)
+    if ranges is not None:
+        return filter_regions(_read_contig_ranges(mpileup, ranges, regions),
+                              regions, PILEUP_CONF)
+    return fetch(mpileup, regions, PILEUP_CONF)
+
+
+def mpileup_contig_ranges(mpileup):
+    """Byte ranges {contig: (start, end)} of the contigs of a plain mpileup,
+    whose lines must be grouped by contig (and sorted by position within a
+    contig, to be read with mpileup_regions)
+    """
+    ranges = OrderedDict()
+    contig, start, offset = None, 0, 0
+    with open(mpileup, 'rb') as f:
+        for line in f:
+            line_contig = line[:line.find(b'\t')].decode()
+            if line_contig != contig:
+                if contig is not None:
+                    ranges[contig] = (start, offset)
+                if line_contig in ranges:
+                    sys.exit("The lines of contig {} are not grouped together \
+in file {}".format(line_contig, mpileup))
+                contig, start = line_contig, offset
+            offset += len(line)
+    if contig is not None:
+        ranges[contig] = (start, offset)
+    return ranges
+
+
+def seek_position(f, start, end, pos):
+    """Seek the binary file f to the first line of the byte range [start, end)
+    (of lines sorted by the position of their second column) at or after the
+    position pos, by bisection
+    """
+    lo, hi = start, end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        _seek_line(f, mid)
+        offset = f.tell()
+        if offset >= end:
+            hi = mid
+            continue
+        line = f.readline()
+        if int(line.split(b'\t', 2)[1]) < pos:
+            lo = offset + len(line)
+        else:
+            hi = mid
+    _seek_line(f, lo)
+
+
+def _seek_line(f, offset):
+    """Seek the binary file f to the first line starting at or after offset
+    """
+    if offset > 0:
+        f.seek(offset - 1)
+        f.readline()
+    else:
+        f.seek(0)
+
+
+def _read_contig_ranges(mpileup, ranges, regions):
+    """Read the lines of a plain mpileup between the first and last positions
+    of the regions of each contig, in its byte range {contig: (start, end)}
+    """
+    with open(mpileup, 'rb') as f:
+        for contig, intervals in merge_regions(regions).items():
+            if contig not in ranges:
+                continue
+            start, end = ranges[contig]
+            last = intervals[-1][1]
+            seek_position(f, start, end, intervals[0][0] + 1)
+            while f.tell() < end:
+                line = f.readline()
+                if int(line.split(b'\t', 2)[1]) > last:
+                    break
+                yield line.decode()
+
+##############################################################################
+
+
+class PileupDict:
+    """All the lines of an mpileup, by position
+    Only the positions in the regions are read, if given (seeking with the
+    .tbi / .csi index of a compressed mpileup, from tabix -s1 -b2 -e2, or
+    bisecting the byte ranges of the contigs of a plain mpileup if given)
+    """
+
+    def __init__(self, mpileup, regions=None, quality=None, ranges=None,
+                 cache_size=PILEUP_CACHE_SIZE):
+        self.name = mpileup
+        self.quality = quality
+        self.cache = PileupCache(cache_size)
+        self._lines = {}
+        # Columns per sample, from the first line
+        self.columns = None
+        with open_mpileup(mpileup) as f:
+            if regions is not None:
+                f = mpileup_regions(mpileup, f, regions, ranges)
+            for line in f:
+                line = line.split('\t')
+                if self.columns is None:
+                    self.columns = sample_columns(line, quality)
+                self._lines['\t'.join(line[:2])] = line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, contig, pos, ref=None, sample=0):
+        key = '\t'.join([contig, str(pos)])
+        line = self._lines.get(key)
+        if not line:
+            return ''
+        return self.cache.get((key, sample), pileup_record, line, sample,
+                              self.quality, self.columns)
+
+    def close(self):
+        pass
+
+
+class PileupStream:
+    """The lines of an mpileup read along the positions of a sorted vcf
+    Positions must be asked for in the contig order {contig: rank} of the
+    vcf, which the mpileup must follow too (lines on other contigs are
+    skipped). Only the current line (and the cached records) are held in
+    memory
+    """
+
+    def __init__(self, mpileup, order, regions=None, quality=None,
+                 cache_size=PILEUP_CACHE_SIZE):
+        self.name = mpileup
+        self.order = order
+        self.quality = quality
+        self.cache = PileupCache(cache_size)
+        self._f = open_mpileup(mpileup)
+        if regions is not None:
+            self._lines = mpileup_regions(mpileup, self._f, regions)
+        else:
+            self._lines = self._f
+        # Position and split line of the current line, and the last position
+        # asked for
+        self._key, self._line = (-1, 0), None
+        self._last = (-1, 0)
+        # Columns per sample, from the first line
+        self.columns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, contig, pos, ref=None, sample=0):
+        try:
+            key = (self.order[contig], pos)
+        except KeyError:
+            sys.exit("Contig '{}' is not declared in the ##contig header \
+lines of the vcf".format(contig))
+        if key < self._last:
+            sys.exit("The vcf is not sorted in ##contig order at {}:{}"
+                     .format(contig, pos))
+        self._last = key
+
+        # Advance the mpileup up to the position
+        while self._key < key:
+            line = next(self._lines, None)
+            if line is None:
+                self._key = (len(self.order), 0)
+                break
+            line = line.split('\t')
+            if self.columns is None:
+                self.columns = sample_columns(line, self.quality)
+            rank = self.order.get(line[0])
+            if rank is None:
+                continue
+            line_key = (rank, int(line[1]))
+            if line_key < self._key:
+                sys.exit("File {} is not sorted in the ##contig order of the \
+vcf at {}:{}".format(self.name, line[0], line[1]))
+            self._key, self._line = line_key, line
+
+        if self._key != key:
+            return ''
+        return self.cache.get((key, sample), pileup_record, self._line,
+                              sample, self.quality, self.columns)
+
+    def close(self):
+        self._f.close()
+
+
+def write_count_store(mpileup, name=None, quality=None):
+    """Write the counts of each position (and sample) of a sorted mpileup to
+    the binary count store name (by default mpileup + COUNT_STORE_EXT),
+    counting only the reads passing the QualityFilter if given. The indels
+    are kept in a temporary file until the rows are written
+    """
+    name = name or mpileup + COUNT_STORE_EXT
+    sequences, contigs = {}, []
+    n_samples = None
+    rows, indels = array('I'), array('I')
+    n_rows, n_indels = 0, 0
+    with open_mpileup(mpileup) as f, open(name, 'wb') as out, \
+            tempfile.TemporaryFile(dir=os.path.dirname(name) or '.') as tmp:
+        last = None, 0
+        for line in f:
+            fields = line.split('\t')
+            contig, pos = fields[0], int(fields[1])
+            if contig != last[0]:
+                if contigs:
+                    contigs[-1][2] = n_rows
+                if any(contig == c[0] for c in contigs):
+                    sys.exit("File {} is not sorted at {}:{}".format(
+                        mpileup, contig, pos))
+                contigs.append([contig, n_rows, n_rows])
+            elif pos <= last[1]:
+                sys.exit("File {} is not sorted at {}:{}".format(
+                    mpileup, contig, pos))
+            last = contig, pos
+            if n_samples is None:
+                columns = sample_columns(fields, quality)
+                n_samples = (len(fields) - 3) // columns
+            elif len(fields) != columns * n_samples + 3:
+                sys.exit("File {} does not have {} samples at {}:{}".format(
+                    mpileup, n_samples, contig, pos))
+            rows.append(pos)
+            for sample in range(n_samples):
+                depth, counts = pileup_record(fields, sample, quality,
+                                              columns)
+                rows.append(int(depth))
+                rows.extend(counts.bases[base] for base in STORE_BASES)
+                rows.append(n_indels)
+                for sign, table in (('+', counts.insertions),
+                                    ('-', counts.deletions)):
+                    for seq, count in table.items():
+                        seq = sign + seq
+                        indels.append(sequences.setdefault(seq,
+                                                           len(sequences)))
+                        indels.append(count)
+                        n_indels += 1
+                rows.append(n_indels)
+            n_rows += 1
+            if len(rows) >= 1 << 20:
+                rows.tofile(out)
+                indels.tofile(tmp)
+                rows, indels = array('I'), array('I')
+        if contigs:
+            contigs[-1][2] = n_rows
+        rows.tofile(out)
+        indels.tofile(tmp)
+        indels_offset = out.tell()
+        tmp.seek(0)
+        shutil.copyfileobj(tmp, out)
+        sequences_offset = out.tell()
+        out.write('\n'.join(sequences).encode())
+        contigs_offset = out.tell()
+        out.write('\n'.join('\t'.join(map(str, c)) for c in contigs).encode())
+        out.write(STORE_TRAILER.pack(indels_offset, sequences_offset,
+                                     contigs_offset, n_samples or 1,
+                                     *store_qualities(quality),
+                                     COUNT_STORE_MAGIC))
+    return name
+
+
+def store_qualities(quality=None):
+    """(min_baseq, min_mapq) of the reads counted in a count store
+    """
+    if quality is None:
+        return 0, 0
+    return quality.min_baseq, quality.min_mapq
+
+
+def find_count_store(mpileup, quality=None):
+    """Path of the count store of an mpileup, if it is not older than the
+    mpileup and counts the reads of the same QualityFilter, or None
+    """
+    if is_pipe(mpileup):
+        return None
+    name = mpileup + COUNT_STORE_EXT
+    if not os.path.exists(name) or \
+       os.path.getmtime(name) < os.path.getmtime(mpileup):
+        return None
+    if count_store_qualities(name) == store_qualities(quality):
+        return name
+    return None
+
+
+def count_store_qualities(name):
+    """(min_baseq, min_mapq) of the reads counted in the count store name, or
+    None if it is not a count store
+    """
+    if is_pipe(name) or not os.path.isfile(name):
+        return None
+    with open(name, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < STORE_TRAILER.size:
+            return None
+        f.seek(-STORE_TRAILER.size, os.SEEK_END)
+        trailer = STORE_TRAILER.unpack(f.read())
+    if trailer[-1] != COUNT_STORE_MAGIC:
+        return None
+    return trailer[4:6]
+
+
+class CountStore:
+    """Pileup records of the positions in a binary count store (see
+    write_count_store), memory-mapped. The bases other than the reference
+    and A, C, G, T, and the read starts and ends, are not stored
+    """
+
+    def __init__(self, name, cache_size=PILEUP_CACHE_SIZE):
+        self.name = name
+        self.cache = PileupCache(cache_size)
+        self._f = open(name, 'rb')
+        try:
+            self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            indels_offset, sequences_offset, contigs_offset, \
+                self.n_samples, _, _, magic = STORE_TRAILER.unpack_from(
+                    self._map, len(self._map) - STORE_TRAILER.size)
+        except (ValueError, struct.error):
+            magic = None
+        if magic != COUNT_STORE_MAGIC:
+            sys.exit('File {} is not a count store'.format(name))
+        data = memoryview(self._map)
+        self._rows = data[:indels_offset].cast('I')
+        self._row = 1 + self.n_samples * STORE_SAMPLE
+        self._positions = self._rows[::self._row]
+        self._indels = data[indels_offset:sequences_offset].cast('I')
+        self._sequences = bytes(data[sequences_offset:contigs_offset]) \
+            .decode().split('\n')
+        self.contigs = {}
+        for line in bytes(data[contigs_offset:-STORE_TRAILER.size]).decode() \
+                .split('\n'):
+            if line:
+                contig, first, last = line.split('\t')
+                self.contigs[contig] = (int(first), int(last))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _record(self, i, sample):
+        """[depth, counts] of a sample in the i-th row
+        """
+        start = i * self._row + 1 + sample * STORE_SAMPLE
+        row = self._rows[start:start + STORE_SAMPLE].tolist()
+        counts = PileupCounts()
+        counts.bases.update(dict(zip(STORE_BASES, row[1:-2])))
+        for j in range(row[-2], row[-1]):
+            seq = self._sequences[self._indels[2 * j]]
+            table = counts.insertions if seq[0] == '+' else counts.deletions
+            table[seq[1:]] += self._indels[2 * j + 1]
+        return [str(row[0]), counts]
+
+    def get(self, contig, pos, ref=None, sample=0):
+        first, last = self.contigs.get(contig, (0, 0))
+        i = bisect_left(self._positions, pos, first, last)
+        if i == last or self._positions[i] != pos:
+            return ''
+        return self.cache.get((i, sample), self._record, i, sample)
+
+    def close(self):
+        # The views of the map are released first
+        self._rows = self._positions = self._indels = None
+        self._map.close()
+        self._f.close()
+
+##############################################################################
+
+
+def bam_column(reads, pos, ref, max_depth=MAX_DEPTH, min_baseq=0):
+    """[depth, counts] of the reads overlapping the 0-based position pos, as
+    shown by samtools mpileup. ref is the reference from pos (the REF of the
+    record), the deleted bases past it are shown as N
+    """
+    counts = PileupCounts()
+    ref_base = ref[0].upper()
+    # Base shown for each read, counted at the end
+    bases = []
+    for read in reads:
+        if len(bases) == max_depth:
+            break
+        # Operation of the CIGAR at the position
+        for end, op, ref_pos, qpos, i in read.blocks:
+            if end > pos:
+                break
+        else:
+            continue
+        reverse = read.flag & BAM_FREVERSE
+        if op != CIGAR_DEL and op != CIGAR_REF_SKIP:
+            qpos += pos - ref_pos
+        # The deletions and skips have the quality of the next base, as in
+        # htslib
+        if min_baseq and (qpos >= len(read.qual) or
+                          read.qual[qpos] < min_baseq):
+            continue
+        if op == CIGAR_DEL:
+            base = '*'
+        elif op == CIGAR_REF_SKIP:
+            base = '<' if reverse else '>'
+        else:
+            base = read.base(qpos)
+            if base == '=' or base == ref_base:
+                base = ',' if reverse else '.'
+            elif reverse:
+                base = base.lower()
+            # Indel following the last base of the operation
+            if pos == end - 1 and i + 1 < len(read.cigar):
+                next_op, next_length = read.cigar[i + 1]
+                if next_op == CIGAR_INS:
+                    seq = read.bases(qpos + 1, next_length)
+                    counts.insertions[seq.lower() if reverse else seq] += 1
+                elif next_op == CIGAR_DEL:
+                    seq = ref[1:next_length + 1].upper().ljust(next_length,
+                                                               'N')
+                    counts.deletions[seq.lower() if reverse else seq] += 1
+            if read.pos == pos:
+                counts.starts += 1
+        if read.end - 1 == pos:
+            counts.ends += 1
+        bases.append(base)
+    counts.bases.update(bases)
+    depth = len(bases)
+    return [str(depth), counts] if depth else ''
+
+
+class BamPileup:
+    """Pileup records of the positions of an indexed BAM file, from the reads
+    overlapping them (see bam_column). The reads of a window of BAM_WINDOW
+    bases are decoded at once, for the next positions nearby. As the deleted
+    bases are shown from the REF of the record, records are cached by
+    position and REF
+    """
+
+    def __init__(self, bam, cache_size=PILEUP_CACHE_SIZE, max_depth=MAX_DEPTH,
+                 min_baseq=0, min_mapq=0):
+        self.name = bam
+        self.cache = PileupCache(cache_size)
+        self.max_depth, self.min_baseq = max_depth, min_baseq
+        self.min_mapq = min_mapq
+        self._bam = BamFile(bam)
+        # Contig, 0-based start and end of the window, its reads with their
+        # starts, and the longest reference span of the reads
+        self._window = (None, 0, 0)
+        self._reads, self._starts, self._span = [], [], 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load(self, contig, pos):
+        """Decode the reads of the window holding the 0-based position
+        """
+        beg = pos - pos % BAM_WINDOW
+        self._window = (contig, beg, beg + BAM_WINDOW)
+        self._reads = [read for read in
+                       self._bam.fetch(contig, beg, beg + BAM_WINDOW)
+                       if not read.flag & SKIP_FLAGS and
+                       read.mapq >= self.min_mapq]
+        self._starts = [read.pos for read in self._reads]
+        self._span = max([read.end - read.pos for read in self._reads] or [0])
+
+    def _column(self, contig, pos, ref):
+        window_contig, beg, end = self._window
+        if contig != window_contig or not beg <= pos < end:
+            self._load(contig, pos)
+        # Reads starting at most the longest span before the position
+        first = bisect_left(self._starts, pos - self._span + 1)
+        last = bisect_right(self._starts, pos)
+        reads = [read for read in self._reads[first:last] if read.end > pos]
+        return bam_column(reads, pos, ref, self.max_depth, self.min_baseq)
+
+    def get(self, contig, pos, ref='N', sample=0):
+        return self.cache.get((contig, pos, ref), self._column, contig,
+                              pos - 1, ref)
+
+    def close(self):
+        self._bam.close()
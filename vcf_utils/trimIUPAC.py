@@ -9,51 +9,114 @@ Modifications:
     03-01-2020 (Jiaan Yu) - Fixed bug when substiting IUPAC code in INDELs
 
 Substitute 'W|K|Y|R|S|M' with 'N'
+The replacements are streamed to stats.jsonl (one JSON object per record),
+stats.json holds their total and the first STATS_REPLACEMENTS of them
 """
 
 ###############################################################################
 
 import sys
-import re
 import os
 import json
+from vcfio import open_vcf, read_header, map_records
 
 # We'll filter out the characters listed in this set:
 # https://en.wikipedia.org/wiki/Nucleic_acid_notation
 character_set = ["W", "S", "M", "K", "R", "Y", "B", "D", "H", "V", "N", "Z"]
+# The alleles made of these characters only have none of them (most records
+# are rejected by stripping them), the others are checked by deleting the
+# characters (a REF / ALT without them is left unchanged), and the
+# characters are substituted with N
+CLEAN_BASES = "ACGT.*,"
+DELETE_IUPAC = str.maketrans("", "", "".join(character_set))
+IUPAC_TO_N = str.maketrans(dict.fromkeys(character_set, "N"))
+
+# Number of replacements kept in stats.json (all are in stats.jsonl)
+STATS_REPLACEMENTS = 1000
+
+USAGE="USAGE: %s [--threads N] <inVcf> <outVcf>\n\nTake out ambiguity (IUPAC) codes in REF and ALT columns by converting them to Ns.\nThe input may be gzip/BGZF compressed, the output is BGZF compressed (and tabix indexed) if it ends in .gz\nUse - for the standard input / output, to run in a pipe\nWith --threads N, chunks of records are processed by N processes (default: 1)\nThe replacements are written to stats.jsonl, their total (and the first %d) to stats.json\n\n" % (sys.argv[0], STATS_REPLACEMENTS)
+
+
+def trim_records(lines, indRef, indAlt):
+    """Substitute the IUPAC codes in the REF and ALT of the records
+    Output the vcf text, the number of lines and the replacements
+    [($line (in the chunk, from 1), { indRef: prev, indAlt: prev })]
+    """
+    output = []
+    chunk_replacements = []
+    n_split = max(indRef, indAlt) + 1
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip("\n\r")
+        processed = line.split("\t", n_split)
+
+        lIndRef, lIndAlt = processed[indRef], processed[indAlt]
+        if not (lIndRef.strip(CLEAN_BASES) or lIndAlt.strip(CLEAN_BASES)):
+            output.append(line + "\n")
+            continue
+        has_indRefMatch = len(lIndRef.translate(DELETE_IUPAC)) != len(lIndRef)
+        has_indAltMatch = len(lIndAlt.translate(DELETE_IUPAC)) != len(lIndAlt)
+        if not (has_indRefMatch or has_indAltMatch):
+            output.append(line + "\n")
+            continue
 
-USAGE="USAGE: %s <inVcf> <outVcf>\n\nTake out ambiguity (IUPAC) codes in REF and ALT columns by converting them to Ns.\n\n" % sys.argv[0]
-
-if len(sys.argv) <= 2:
-    print(USAGE + "\033[91mError: An invalid number of parameters was provided (%s / 2).\033[0m\n" % (len(sys.argv) -1))
+        d = {}
+        if has_indRefMatch:
+            d["indRef"] = lIndRef
+            processed[indRef] = lIndRef.translate(IUPAC_TO_N)
+
+        if has_indAltMatch:
+            d["indAlt"] = lIndAlt
+            processed[indAlt] = lIndAlt.translate(IUPAC_TO_N)
+
+        chunk_replacements.append((line_number, d))
+        output.append("\t".join(processed) + "\n")
+    return "".join(output), len(lines), chunk_replacements
+
+
+args = sys.argv[1:]
+threads = 1
+if "--threads" in args:
+    i = args.index("--threads")
+    try:
+        threads = int(args[i + 1])
+    except (IndexError, ValueError):
+        threads = 0
+    if threads < 1:
+        print(USAGE + "\033[91mError: --threads must be followed by a number of at least 1.\033[0m\n")
+        sys.exit(1)
+    del args[i:i + 2]
+
+if len(args) <= 1:
+    print(USAGE + "\033[91mError: An invalid number of parameters was provided (%s / 2).\033[0m\n" % len(args))
     sys.exit(1)
 
-inpath = sys.argv[1]
-outpath = sys.argv[2]
+inpath = args[0]
+outpath = args[1]
 
-if not os.path.exists(inpath):
+if inpath != "-" and not os.path.exists(inpath):
     print("\033[91mThe input file '%s' could not be found, or is not accessible\033[0m" % inpath)
     sys.exit(1)
 
-if os.path.exists(outpath):
+if outpath != "-" and os.path.exists(outpath):
     print("\033[91mA file already exists at the output path '%s'\033[0m" % outpath)
     sys.exit(1)
 
 replacements = 0
+records = 0
 replacement_dict = {
-    # $line: { indRef: prev, indAlt: prev }
+    # $line: { indRef: prev, indAlt: prev }, for the first STATS_REPLACEMENTS
 }
 
 line_number = 0
 
-with open(inpath) as inputfp, open(outpath,'w') as outputfp:
+with open_vcf(inpath) as inputfp, open_vcf(outpath, 'w') as outputfp, \
+        open("stats.jsonl", "w") as stats_lines:
     extrahead_elems = []
 
     indRef = None   # header.index("REF")
     indAlt = None   # header.index("ALT")
 
-    p = re.compile("|".join(character_set))
-    for line in inputfp:
+    for line in read_header(inputfp):
         line_number += 1    # was started at 0, so lines will start at 1
 
         if line.startswith("##"):
@@ -64,32 +127,28 @@ with open(inpath) as inputfp, open(outpath,'w') as outputfp:
         # probably write extrahead params here
 
         processed = line.rstrip("\n\r").split("\t")
-
-        if indRef is None or indAlt is None:
-            indRef = processed.index("REF")
-            indAlt = processed.index("ALT")
-        else:
-            lIndRef, lIndAlt = processed[indRef], processed[indAlt]
-            has_indRefMatch = p.search(lIndRef)
-            has_indAltMatch = p.search(lIndAlt)
-            if has_indRefMatch or has_indAltMatch:
-                d = {}
-                if has_indRefMatch:
-                    d["indRef"] = lIndRef
-                    processed[indRef] = p.sub("N", str(lIndRef))
-
-                if has_indAltMatch:
-                    d["indAlt"] = lIndAlt                
-                    processed[indAlt] = p.sub("N", str(lIndAlt))
-
-                replacement_dict[line_number] = d
-                replacements += len(d)
-
+        indRef = processed.index("REF")
+        indAlt = processed.index("ALT")
         outputfp.write("\t".join(processed) + "\n")
 
+    # The records of a file are read again by map_records (by byte ranges
+    # with --threads), those of the standard input are read on
+    for text, n_lines, chunk_replacements in map_records(
+            inputfp if inpath == "-" else inpath, trim_records,
+            (indRef, indAlt), threads):
+        for chunk_line, d in chunk_replacements:
+            stats_lines.write(json.dumps({"line": line_number + chunk_line,
+                                          **d}) + "\n")
+            if len(replacement_dict) < STATS_REPLACEMENTS:
+                replacement_dict[line_number + chunk_line] = d
+            replacements += len(d)
+            records += 1
+        line_number += n_lines
+        outputfp.write(text)
+
 with open("stats.json", "w+") as stats:
     json.dump({
         "total": replacements,
+        "records": records,
         "replacements": replacement_dict
     }, stats)
-
@@ -1,5 +1,6 @@
+import sys
 from collections import OrderedDict
-from statistics import mean, stdev
+from math import sqrt
 
 
 BAM_STATS_LINES = ['##FORMAT=<ID=PMCDP,Number=1,Type=Integer,Description="Total \
@@ -40,178 +41,332 @@ def normalise_GT(old_gt):
     return gt
 
 
+def mean_sd(values):
+    """Mean (rounded to an int) and sd (rounded to 2 decimals, None for a
+    single value) of a list of ints. The same as statistics.mean / stdev,
+    from integer sums instead of fractions
+    """
+    n, total = len(values), sum(values)
+    if n == 1:
+        return round(total / n), None
+    squares = n * sum(v * v for v in values) - total * total
+    return round(total / n), round(sqrt(squares / (n * (n - 1))), 2)
+
+
 def cal_AD(AD):
-    """Calculate the average and sd of AD
+    """Calculate the average and sd of AD, for each allele (the missing
+    values '.' are skipped)
     """
     # Remove the AD if missing in specific caller
-    AD = [k for k in AD if k != '.']
+    AD = [v.split(',') for v in AD if v != '.']
     if AD == []:
         col_mean, col_sd = '.,.', '.,.'
+    elif len(AD) == 1:
+        col_mean = ','.join(i if i == '.' else str(int(i)) for i in AD[0])
+        col_sd = '.,.'
     else:
-        AD = [[int(i) for i in v.split(',')] for v in AD]
-        if len(AD) == 1:
-            col_mean, col_sd = ','.join(str(i) for i in AD[0]), '.,.'
-        else:
-            col_mean = ','.join([str(i) for i in map(lambda x: round(mean(x),
-                                 ), zip(*AD))])
-            col_sd = ','.join([str(i) for i in map(lambda x: round(stdev(x),
-                              2), zip(*AD))])
+        col_mean, col_sd = [], []
+        for allele in zip(*AD):
+            allele = [int(i) for i in allele if i != '.']
+            if allele == []:
+                col_mean.append('.')
+                col_sd.append('.')
+                continue
+            allele_mean, allele_sd = mean_sd(allele)
+            col_mean.append(str(allele_mean))
+            col_sd.append('.' if allele_sd is None else str(allele_sd))
+        col_mean, col_sd = ','.join(col_mean), ','.join(col_sd)
     return col_mean, col_sd
 
 def cal_DP(DP):
     """Calculate the average and sd of DP
     """
     # Remove the DP if missing
-    DP = [k for k in DP if k != '.']
+    DP = [int(v) for v in DP if v != '.']
     if DP == []:
         col_mean, col_sd = '.', '.'
     else:
-        DP = [int(v) for v in DP]
-        if len(DP) == 1:
-            col_mean, col_sd = str(DP[0]), '.'
-        else:
-            col_mean, col_sd = str(round(mean(DP))), str(round(stdev(DP), 2))
+        col_mean, col_sd = mean_sd(DP)
+        col_mean = str(col_mean)
+        col_sd = '.' if col_sd is None else str(col_sd)
 
     return col_mean, col_sd
 
 ###############################################################################
 
 
-class Variant:
+class Fields:
+    """Ordered INFO / FORMAT values of a variant, read like a dictionary
+    The names are a tuple shared by all the variants with the same columns,
+    the values a tuple (a Fields per sample for somatic FORMAT)
     """
+
+    __slots__ = ('names', 'values')
+
+    def __init__(self, items=()):
+        self.names, self.values = (), ()
+        if items:
+            self.update(items)
+
+    @classmethod
+    def from_names(cls, names, values):
+        """Create from a tuple of names and their values, without checking
+        for duplicated names
+        """
+        fields = cls.__new__(cls)
+        fields.names, fields.values = _shared_names(names), tuple(values)
+        return fields
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, name):
+        try:
+            return self.values[self.names.index(name)]
+        except ValueError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, val):
+        try:
+            i = self.names.index(name)
+        except ValueError:
+            self.names = _shared_names(self.names + (name,))
+            self.values += (val,)
+        else:
+            self.values = self.values[:i] + (val,) + self.values[i + 1:]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.names
+
+    def items(self):
+        return zip(self.names, self.values)
+
+    def update(self, items):
+        """Set the values of a dictionary or (name, value) pairs, in order
+        """
+        fields = dict(zip(self.names, self.values))
+        fields.update(items)
+        self.names = _shared_names(tuple(fields))
+        self.values = tuple(fields.values())
+
+
+# One tuple per combination of INFO / FORMAT names
+_FIELD_NAMES = {}
+
+
+def _shared_names(names):
+    return _FIELD_NAMES.setdefault(names, names)
+
+
+def parse_info(info):
+    """(name, value) pairs of the INFO column, flags have the value of their
+    name
     """
+    pairs = []
+    for i in info.split(';'):
+        i = i.split('=')
+        pairs.append((i[0], i[1] if len(i) > 1 else i[0]))
+    return pairs
+
+
+def info_value(info, name):
+    """Value of one name in the INFO column (the name for a flag), found
+    without splitting the column. None if missing
+    """
+    start = 0
+    while True:
+        i = info.find(name, start)
+        if i == -1:
+            return None
+        end = i + len(name)
+        if (i == 0 or info[i - 1] == ';') and \
+           (end == len(info) or info[end] in '=;'):
+            if end == len(info) or info[end] == ';':
+                return name
+            stop = info.find(';', end)
+            return info[end + 1:stop if stop != -1 else len(info)] \
+                .split('=')[0]
+        start = i + 1
+
+
+def cal_AF(format_):
+    """Allele frequency from the AD and DP of a sample, '.' if missing
+    """
+    try:
+        return str(round(float(format_['AD'].split(',')[1]) /
+                         float(format_['DP']), 2))
+    except:
+        return '.'
+
+###############################################################################
+
+
+class Variant:
+    """A vcf record, with the contig and FILTER interned and the position as
+    an int. info and format are Fields (format holds 'normal' and 'tumor'
+    Fields for somatic variants). After read_variant they are only decoded
+    when first used, and written back as read until then
+    """
+
+    __slots__ = ('chr', 'pos', 'sample_id', 'ref', 'alt', 'qual', 'filter',
+                 '_info', '_format', '_raw', '_samples')
 
     def __init__(self):
         """
         """
         self.chr = ''
-        self.pos = ''
+        self.pos = 0
         self.ref = ''
         self.alt = ''
         self.sample_id = ''
         self.qual = ''
         self.filter = ''
-        self.mandatory = []
-        self.info, self.format = OrderedDict(), OrderedDict()
+        self.info, self.format = Fields(), Fields()
+        # The (INFO, FORMAT, samples...) text of read_variant, and the sample
+        # names of a multi-sample variant
+        self._raw = None
+        self._samples = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = Fields(parse_info(self._raw[0]))
+        return self._info
+
+    @info.setter
+    def info(self, info):
+        self._info = info
+
+    @property
+    def format(self):
+        if self._format is None:
+            names = self._raw[1].split(':')
+            if self._samples is not None:
+                # The trailing values a sample may drop are filled in, for
+                # all the samples to have the same FORMAT
+                samples = [sample.split(':') for sample in self._raw[2:]]
+                self._format = Fields(zip(self._samples, [
+                    Fields.from_names(tuple(names), values + ['.'] *
+                                      (len(names) - len(values)))
+                    for values in samples]))
+                return self._format
+            samples = [Fields(zip(names, sample.split(':'))) for sample in
+                       self._raw[2:]]
+            if len(samples) == 1:
+                self._format = samples[0]
+            else:
+                self._format = Fields(zip(['normal', 'tumor'], samples))
+        return self._format
 
-    def process_variant(self, line, caller):
-        """Create variant from line (with processing of GT and AF)
-        """
-        line = line.strip().split('\t')
-        self.chr = line[0]
-        self.pos = line[1]
-        self.sample_id = line[2]
-        self.ref = line[3]
-        self.alt = line[4]
-        self.qual = line[5]
-        self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
-        for name, val in zip(line[8].split(':'), line[9].split(':')):
-            self.format[name] = val
-
-        # Normalise GT
-        self.format['GT'] = normalise_GT(self.format['GT'])
-
-        # Get AF and DP
-        if caller == 'strelka':
-            # use DPI as DP for INDELs in strelka
-            if "DPI" in self.format.keys():
-                self.format['DP'] = self.format.get("DPI", ".")
-
-        # Calculate the allele frequency regardless
-        try:
-            self.info['AF'] = str(round(float(self.format['AD'].split(',')
-                                  [1]) / float(self.format['DP']), 2))
-        except:
-            self.info['AF'] = '.'
-
-        # Replace the AD / DP values in INFO with FORMAT
-        if 'AD' in self.format.keys():
-            self.info['AD'] = self.format['AD']
-        if 'DP' in self.format.keys():
-            self.info['DP'] = self.format['DP']
-        return self
+    @format.setter
+    def format(self, format_):
+        self._format = format_
 
-    def process_somatic_variant(self, line, caller, n_index, t_index):
-        """Create somatic variant from line (with normalisation of GT)
+    @property
+    def variant_key(self):
+        """chr\tpos\tref\talt
         """
+        return '\t'.join([self.chr, str(self.pos), self.ref, self.alt])
 
+    def _read_mandatory(self, line):
+        """Split the line and set the first 7 columns
+        """
         line = line.strip().split('\t')
-        self.chr = line[0]
-        self.pos = line[1]
+        self.chr = sys.intern(line[0])
+        self.pos = int(line[1])
         self.sample_id = line[2]
         self.ref = line[3]
         self.alt = line[4]
         self.qual = line[5]
-        self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-        normal_dict, tumor_dict = OrderedDict(), OrderedDict()
-
-        # Prevent the single tag situation, like "SOMATIC;" (in strelka)
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
-        for name, val in zip(line[8].split(':'), line[n_index].split(':')):
-            normal_dict[name] = val
-        for name, val in zip(line[8].split(':'), line[t_index].split(':')):
-            tumor_dict[name] = val
+        self.filter = sys.intern(line[6])
+        return line
+
+    def read_variant(self, line, somatic=False, normal=None, tumor=None,
+                     samples=None):
+        """Create variant from line (no processing, INFO and FORMAT are
+        decoded on first use)
+        With the sample names of the header, all the samples are read (FORMAT
+        is then a Fields per sample)
+        """
 
-        # Normalise GT (no GT in strelka)
-        if caller == 'strelka':
-            pass
+        line = self._read_mandatory(line)
+        if samples is not None:
+            self._raw = (line[7], line[8]) + tuple(line[9:9 + len(samples)])
+            self._samples = tuple(samples)
+        elif not somatic:
+            self._raw = (line[7], line[8], line[9])
         else:
-            normal_dict['GT'] = normalise_GT(normal_dict['GT'])
-            tumor_dict['GT'] = normalise_GT(tumor_dict['GT'])
-
-        # self.foramt would be a dict containing two dicts, normal and tumor
-        self.format['normal'] = normal_dict
-        self.format['tumor'] = tumor_dict
+            self._raw = (line[7], line[8], line[normal], line[tumor])
+        self._info, self._format = None, None
 
         return self
 
-    def read_variant(self, line, somatic=False, normal=None, tumor=None):
-        """Create variant from line (no processing)
+    def variant_class(self):
+        """SNV, INDEL or OTHER (MNPs and complex variants), from each ALT allele
+        of a multi-allelic variant: OTHER if the alleles are of different
+        classes
         """
+        classes = set()
+        for alt in self.alt.split(','):
+            if len(self.ref) == len(alt) == 1:
+                classes.add('SNV')
+            elif len(self.ref) != len(alt):
+                classes.add('INDEL')
+            else:
+                classes.add('OTHER')
+        return classes.pop() if len(classes) == 1 else 'OTHER'
 
-        line = line.strip().split('\t')
-        self.chr = line[0]
-        self.pos = line[1]
-        self.sample_id = line[2]
-        self.ref = line[3]
-        self.alt = line[4]
-        self.qual = line[5]
-        self.filter = line[6]
-        self.mandatory = line[:7]
-        self.variant_key = '\t'.join(line[:2] + line[3:5])
-
-        for i in line[7].split(';'):
-            try:
-                self.info[i.split('=')[0]] = i.split('=')[1]
-            except:
-                self.info[i] = i
+    def allele_frequency(self, somatic=False):
+        """Alt allele frequency from the (mean) AD in FORMAT, of the tumor
+        if somatic. None if AD is missing
+        """
+        format_ = self.format['tumor'] if somatic else self.format
+        try:
+            AD = [int(i) for i in format_['AD'].split(',')]
+            return sum(AD[1:]) / sum(AD)
+        except (KeyError, ValueError, ZeroDivisionError):
+            return None
 
+    def pack(self, somatic=False):
+        """Compact tuple of the variant, to pass between processes
+        """
         if not somatic:
-            for name, val in zip(line[8].split(':'), line[9].split(':')):
-                self.format[name] = val
+            format_ = (self.format.names, self.format.values)
         else:
-            normal_dict, tumor_dict = OrderedDict(), OrderedDict()
-            for name, val in zip(line[8].split(':'), line[normal].split(':')):
-                normal_dict[name] = val
-            for name, val in zip(line[8].split(':'), line[tumor].split(':')):
-                tumor_dict[name] = val
-            self.format['normal'] = normal_dict
-            self.format['tumor'] = tumor_dict
-
-        return self
+            format_ = tuple((self.format[i].names, self.format[i].values)
+                            for i in ['normal', 'tumor'])
+        return (self.chr, self.pos, self.sample_id, self.ref, self.alt,
+                self.qual, self.filter, (self.info.names, self.info.values),
+                format_)
+
+    @classmethod
+    def unpack(cls, packed, somatic=False):
+        """Create variant from the tuple of Variant.pack
+        """
+        variant = cls()
+        (chr_, variant.pos, variant.sample_id, variant.ref, variant.alt,
+         variant.qual, filter_, info, format_) = packed
+        variant.chr, variant.filter = sys.intern(chr_), sys.intern(filter_)
+        variant.info = Fields.from_names(*info)
+        if not somatic:
+            variant.format = Fields.from_names(*format_)
+        else:
+            variant.format = Fields.from_names(
+                ('normal', 'tumor'), [Fields.from_names(*format_[0]),
+                                      Fields.from_names(*format_[1])])
+        return variant
 
     def select_info(self, i_dict, f_dict, caller=None, somatic=False):
         """ Update the variant with the selected columns
@@ -261,8 +416,12 @@ class Variant:
                         new_format['tumor']['GT'] = '.'
                     else:
                         pass
-        self.info = new_info
-        self.format = new_format
+        self.info = Fields(new_info)
+        if not somatic:
+            self.format = Fields(new_format)
+        else:
+            self.format = Fields((i, Fields(new_format[i])) for i in
+                                 ['normal', 'tumor'])
 
         return self
 
@@ -320,69 +479,54 @@ class Variant:
 
         for name, val in zip(new_info_names, new_info_vals):
             new_info[name] = val
-        self.info = new_info
+        self.info = Fields(new_info)
         # Set filter value of combined variant to .
         self.filter = '.'
         return self
 
     def cal_bam_stats(self, pileup_line):
-        """Calculate the bam stats from the pileup line
+        """Calculate the bam stats from the pileup record [depth, counts]
+           (counts is the pileup.PileupCounts table of the bases column)
         """
-        if pileup_line:
+        # A position without reads (or none passing the quality filters)
+        # has no counts
+        if pileup_line and pileup_line[0] != '0':
 
-            pileup = pileup_line[1]
+            counts = pileup_line[1]
             total_depth = int(pileup_line[0])
-            ref_fwd = pileup.count('.')
-            ref_rev = pileup.count(',')
+            ref_fwd = counts.bases['.']
+            ref_rev = counts.bases[',']
 
             # SNV
-            if len(self.ref) == len(self.alt):
-
-                # Recursively remove the indels to avoid counting the indels
-                while '-' in pileup:
-                    index = pileup.index('-')
-                    # check length of indel, which may be multiple characters (>=10)
-                    i=1
-                    length=""
-                    while pileup[index+i] in [str(x) for x in range(0,10)]:
-                        length += pileup[index+i]
-                        i+=1
-                    length = int(length)
-                    pileup = pileup[:index] + pileup[index+length+i:]
-                while '+' in pileup:
-                    index = pileup.index('+')
-                    i=1
-                    length=""
-                    while pileup[index+i] in [str(x) for x in range(0,10)]:
-                        length += pileup[index+i]
-                        i+=1
-                    length = int(length)
-                    pileup = pileup[:index] + pileup[index+length+i:]
-                alt_fwd = pileup.count(self.alt)
-                alt_rev = pileup.count(self.alt.lower())
-
-            # Insertion, eg. ref 'C' alt 'CCA'
+            if len(self.ref) == len(self.alt) == 1:
+
+                alt_fwd, alt_rev = counts.strands(self.alt)
+
+            # MNP: a pileup line shows one base per read, so the reads of
+            # the whole ALT are not known
+            elif len(self.ref) == len(self.alt):
+
+                return [total_depth, ref_fwd + ref_rev, '.', '.', ref_fwd,
+                        ref_rev, '.', '.', 'N/A']
+
+            # Insertion, eg. ref 'C' alt 'CCA' (+2CA/+2ca in the pileup)
             elif len(self.ref) == 1 and len(self.alt) > 1:
 
-                # Look for the pattern +2CA/+2ca (+, length of insertion, bases)
-                alt_fwd = pileup.count('+' + str(len(self.alt[1:])) + self.alt[1:])
-                alt_rev = pileup.count('+' + str(len(self.alt[1:])) +
-                                       self.alt[1:].lower())
+                alt_fwd, alt_rev = counts.strands(self.alt[1:],
+                                                  counts.insertions)
                 # Recalcualte the reference supporting reads (pileup report the
                 # reference match followed by indels)
                 ref_fwd -= alt_fwd
                 ref_rev -= alt_rev
 
             elif len(self.ref) > 1 and len(self.alt) == 1:
-                alt_fwd = pileup.count('-' + str(len(self.ref[1:])) +
-                                       self.ref[1:])
-                alt_rev = pileup.count('-' + str(len(self.ref[1:])) +
-                                       self.ref[1:].lower())
+                alt_fwd, alt_rev = counts.strands(self.ref[1:],
+                                                  counts.deletions)
                 ref_fwd -= alt_fwd
                 ref_rev -= alt_rev
 
             else:
-                # The MNP and other werid variants
+                # The complex variants
                 alt_fwd, alt_rev = 0, 0
 
             ref_reads = ref_fwd + ref_rev
@@ -412,50 +556,161 @@ class Variant:
         # Add the values to format
         new_format = ["PMCDP", "PMCRD", "PMCAD", "PMCFREQ", "PMCRDF", "PMCRDR",
                       "PMCADF", "PMCADR", "PMCBDIR"]
-        if not somatic:
-            for name, val in zip(new_format, bam_stats):
-                self.format[name] = str(val)
+        if self._samples is not None:
+            # bam_stats is {sample: bam stats}, the other samples get '.'
+            for sample in self._samples:
+                values = bam_stats.get(sample, ['.'] * len(new_format))
+                self.format[sample].update(zip(new_format, map(str, values)))
+        elif not somatic:
+            self.format.update(zip(new_format, map(str, bam_stats)))
         else:
-            for name, val in zip(new_format, bam_stats[0]):
-                self.format['normal'][name] = str(val)
-            for name, val in zip(new_format, bam_stats[1]):
-                self.format['tumor'][name] = str(val)
+            self.format['normal'].update(zip(new_format,
+                                             map(str, bam_stats[0])))
+            self.format['tumor'].update(zip(new_format,
+                                            map(str, bam_stats[1])))
         return self
 
     def write(self, somatic=False):
         """Write modified variant line
         """
-        if not somatic:
-            info_, format_names, format_vals = [], [], []
-            for name, val in self.info.items():
-                if name == val:
-                    info_.append(name)
-                else:
-                    info_.append('='.join([name, val]))
-            for name, val in self.format.items():
-                format_names.append(name)
-                format_vals.append(val)
-            return ('\t'.join([self.chr, self.pos, self.sample_id, 
-                               self.ref, self.alt, self.qual, self.filter] + 
-                              [';'.join(info_), ':'.join(format_names), 
-                               ':'.join(format_vals)]) + '\n')
+        if self._info is None:
+            info_ = self._raw[0]
+        else:
+            info_ = ';'.join(name if name == val else '='.join([name, val])
+                             for name, val in self._info.items())
+        if self._format is None:
+            format_ = list(self._raw[1:])
+        elif self._samples is not None:
+            samples = self._format.values
+            format_ = [':'.join(samples[0].names)] + \
+                [':'.join(sample.values) for sample in samples]
+        elif not somatic:
+            format_ = [':'.join(self._format.names),
+                       ':'.join(self._format.values)]
+        else:
+            format_ = [':'.join(self._format['normal'].names),
+                       ':'.join(self._format['normal'].values),
+                       ':'.join(self._format['tumor'].values)]
+        return ('\t'.join([self.chr, str(self.pos), self.sample_id,
+                           self.ref, self.alt, self.qual, self.filter,
+                           info_] + format_) + '\n')
+
+###############################################################################
+
+
+class ColumnDecoder:
+    """Decode the variant lines of a vcf into the selected INFO / FORMAT
+    columns only, built once per file from the columns of its header.
+    decode(line) gives the same variant as process_(somatic_)variant then
+    select_info, without splitting the whole INFO / FORMAT columns
+    """
 
+    def __init__(self, i_dict, f_dict, caller, somatic=False, n_index=9,
+                 t_index=10):
+        """
+        Input:
+            the selected info, format dictionaries {col: header object}
+            the caller, and the normal / tumor columns of a somatic vcf
+        """
+        self.i_dict, self.f_dict = i_dict, f_dict
+        self.caller, self.somatic = caller, somatic
+        self.n_index, self.t_index = n_index, t_index
+
+        # The FORMAT names to read from the samples
+        names = ['GT'] + list(f_dict)
+        if not somatic:
+            names += ['AD', 'DP', 'DPI'] + list(i_dict)
         else:
-            info_, format_names, normal_format_vals, tumor_format_vals =\
-                [], [], [], []
-            for name, val in self.info.items():
-                if name == val:
-                    info_.append(name)
-                else:
-                    info_.append('='.join([name, val]))
-            for name, val in self.format['normal'].items():
-                format_names.append(name)
-                normal_format_vals.append(val)
-            for name, val in self.format['tumor'].items():
-                tumor_format_vals.append(val)
-            return ('\t'.join([self.chr, self.pos, self.sample_id,
-                               self.ref, self.alt, self.qual, self.filter] + 
-                              [';'.join(info_), ':'.join(format_names), 
-                               ':'.join(normal_format_vals), 
-                               ':'.join(tumor_format_vals)]) + '\n')
+            names += [k.strip('_normal') for k in i_dict] + \
+                     [k.strip('_tumor') for k in i_dict]
+        self._names = list(OrderedDict.fromkeys(names))
+        self._info_names = tuple(v.meta_id for v in i_dict.values())
+        self._format_names = tuple(v.meta_id for v in f_dict.values())
+        # {FORMAT column: [(name, index)]}, of the names to read
+        self._schemas = {}
+
+    def _sample(self, format_, sample):
+        """Dictionary of the FORMAT names to read, in a sample column
+        """
+        schema = self._schemas.get(format_)
+        if schema is None:
+            names = format_.split(':')
+            schema = [(name, names.index(name)) for name in self._names
+                      if name in names]
+            self._schemas[format_] = schema
+        vals = sample.split(':')
+        return {name: vals[i] for name, i in schema if i < len(vals)}
+
+    def decode(self, line):
+        """Create variant with the selected columns from line
+        """
+        variant = Variant()
+        line = variant._read_mandatory(line)
+        if not self.somatic:
+            return self._decode_germline(variant, line)
+        return self._decode_somatic(variant, line)
+
+    def _decode_germline(self, variant, line):
+        format_ = self._sample(line[8], line[9])
+        if 'GT' in format_:
+            format_['GT'] = normalise_GT(format_['GT'])
+        # use DPI as DP for INDELs in strelka
+        if self.caller == 'strelka' and 'DPI' in format_:
+            format_['DP'] = format_['DPI']
+
+        new_info = []
+        for k in self.i_dict:
+            # The AF is calculated regardless, AD / DP are taken from FORMAT
+            if k == 'AF':
+                info = cal_AF(format_)
+            elif k in ['AD', 'DP'] and k in format_:
+                info = format_[k]
+            else:
+                info = info_value(line[7], k)
+                if info is None:
+                    info = '.'
+            if not info:
+                info = format_.get(k, '.')
+            new_info.append(info)
+        variant.info = Fields.from_names(self._info_names, new_info)
+        variant.format = Fields.from_names(
+            self._format_names, [format_.get(k, '.') for k in self.f_dict])
+        return variant
+
+    def _decode_somatic(self, variant, line):
+        normal = self._sample(line[8], line[self.n_index])
+        tumor = self._sample(line[8], line[self.t_index])
+        # Normalise GT (no GT in strelka)
+        if self.caller != 'strelka':
+            for sample in [normal, tumor]:
+                if 'GT' in sample:
+                    sample['GT'] = normalise_GT(sample['GT'])
+
+        new_info = []
+        for k in self.i_dict:
+            info = info_value(line[7], k)
+            if info is not None:
+                new_info.append((k, info))
+                continue
+            # This column has normal / tumor
+            if k.endswith('normal'):
+                info = normal.get(k.strip('_normal'))
+            else:
+                info = tumor.get(k.strip('_tumor'))
+            if info is not None:
+                new_info.append(('{}_{}'.format(k, self.caller), info))
 
+        new_normal, new_tumor = OrderedDict(), OrderedDict()
+        for k in self.f_dict:
+            try:
+                new_normal[k] = normal[k]
+                new_tumor[k] = tumor[k]
+            except KeyError:
+                if k == 'GT':
+                    new_normal['GT'] = '.'
+                    new_tumor['GT'] = '.'
+        variant.info = Fields(new_info)
+        variant.format = Fields.from_names(('normal', 'tumor'),
+                                           [Fields(new_normal),
+                                            Fields(new_tumor)])
+        return variant
@@ -0,0 +1,895 @@
+"""
+Reading and writing of plain and BGZF compressed vcfs
+
+open_vcf reads plain, gzip or BGZF (bgzip) compressed files transparently
+(inflating the BGZF blocks ahead of the reader on a thread pool), and writes
+BGZF with a tabix (.tbi) index, built in the same pass, when the
+output name ends in '.gz' (compressing the blocks on a thread pool)
+fetch reads the records overlapping a list of regions, seeking with the
+.tbi / .csi index when there is one
+map_records yields a per-record transform of the chunks of records of a vcf,
+in order, computing the chunks in a pool of processes: an uncompressed vcf is
+memory-mapped and split into newline-aligned byte ranges read by the workers
+external_sort sorts lines in a memory budget, spilling compressed sorted runs
+to temporary files
+BgzfReader and TabixIndex also read BAM files and their .bai index (bam.py)
+"""
+
+import io
+import mmap
+import os
+import re
+import gzip
+import heapq
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+##############################################################################
+
+# Uncompressed size of a BGZF block, as in htslib
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000'
+                         '000000')
+
+# Threads inflating / compressing the BGZF blocks of a file read / written by
+# open_vcf (zlib releases the GIL), and the number of blocks in flight
+BGZF_THREADS = min(8, os.cpu_count() or 1)
+BGZF_QUEUE = 64
+
+# Tabix binning scheme (min_shift 14, depth 5)
+TBI_MIN_SHIFT, TBI_DEPTH = 14, 5
+TBI_PSEUDO_BIN = 37450
+TBI_FORMAT_VCF = 2
+
+# Tabix (format, col_seq, col_beg, col_end) of vcf and mpileup files
+VCF_CONF = (TBI_FORMAT_VCF, 1, 2, 0)
+PILEUP_CONF = (0, 1, 2, 2)
+
+# End of a region without end (samtools uses the largest position in BAM)
+MAX_POS = 1 << 31
+
+# Estimated memory of a line held in a sort run, on top of its length
+SORT_LINE_OVERHEAD = 120
+
+# Bytes of records in a chunk transformed by map_records
+MAP_CHUNK_SIZE = 1 << 22
+
+##############################################################################
+
+
+def open_vcf(name, mode='r'):
+    """Open a vcf (or other tab-delimited text file, e.g. mpileup)
+    Reading: plain, gzip or BGZF compressed, detected from the content
+    Writing: BGZF with a .tbi index if the name ends in '.gz', otherwise plain
+    '-' is the standard input / output (left open on close)
+    """
+    if name == '-':
+        if 'w' in mode:
+            return open(sys.stdout.fileno(), 'w', closefd=False)
+        stream = open(sys.stdin.fileno(), 'rb', closefd=False)
+        if stream.peek(2)[:2] == b'\x1f\x8b':
+            stream = gzip.GzipFile(fileobj=stream)
+        return io.TextIOWrapper(stream)
+    if 'w' in mode:
+        if name.endswith('.gz'):
+            return BgzfWriter(name)
+        return open(name, 'w')
+    with open(name, 'rb') as f:
+        header = f.read(len(BGZF_HEADER))
+    if is_bgzf_header(header):
+        return io.TextIOWrapper(io.BufferedReader(BgzfBlockStream(name)))
+    if header[:2] == b'\x1f\x8b':
+        return gzip.open(name, 'rt')
+    return open(name, 'r')
+
+
+def is_bgzf_header(header):
+    """Check whether the first bytes of a file are the header of a BGZF block
+    (a gzip member with the BC extra subfield of the block size)
+    """
+    return len(header) >= 16 and header[:4] == BGZF_HEADER[:4] and \
+        header[12:14] == b'BC'
+
+
+def is_compressed(name):
+    """Check whether a file is gzip / BGZF compressed
+    """
+    with open(name, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def reg2bin(beg, end, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """Tabix bin of the 0-based region [beg, end)
+    """
+    end -= 1
+    for level in range(depth, 0, -1):
+        shift = min_shift + 3 * (depth - level)
+        if beg >> shift == end >> shift:
+            return ((1 << 3 * level) - 1) // 7 + (beg >> shift)
+    return 0
+
+
+def reg2bins(beg, end, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """All the bins overlapping the 0-based region [beg, end)
+    """
+    end -= 1
+    bins = []
+    for level in range(depth + 1):
+        shift = min_shift + 3 * (depth - level)
+        offset = ((1 << 3 * level) - 1) // 7
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def parse_region(region):
+    """Parse a samtools style region 'chr', 'chr:start' or 'chr:start-end'
+    (1-based, inclusive)
+    Output (contig, beg, end), 0-based and half-open
+    """
+    match = re.match(r'^(.+):([0-9,]+)(?:-([0-9,]*))?$', region)
+    if not match:
+        return (region, 0, MAX_POS)
+    start, end = match.group(2).replace(',', ''), (match.group(3) or '')
+    end = end.replace(',', '')
+    return (match.group(1), max(int(start) - 1, 0),
+            int(end) if end else MAX_POS)
+
+
+def read_bed(bed):
+    """Read the regions of a bed file
+    Output [(contig, beg, end)], 0-based and half-open
+    """
+    regions = []
+    with open_vcf(bed) as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.split('\t')
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+
+def merge_regions(regions):
+    """Sort and merge the overlapping regions, by contig
+    Output {contig: [(beg, end)]}, contigs in order of first appearance
+    """
+    merged = OrderedDict()
+    for contig, beg, end in regions:
+        merged.setdefault(contig, []).append((beg, end))
+    for contig, intervals in merged.items():
+        intervals.sort()
+        merged[contig] = [intervals[0]]
+        for beg, end in intervals[1:]:
+            if beg <= merged[contig][-1][1]:
+                merged[contig][-1] = (merged[contig][-1][0],
+                                      max(end, merged[contig][-1][1]))
+            else:
+                merged[contig].append((beg, end))
+    return merged
+
+
+def line_span(fields, conf=VCF_CONF):
+    """Region of a (split) line
+    Output (contig, beg, end), 0-based and half-open
+    """
+    fmt, col_seq, col_beg, col_end = conf
+    beg = int(fields[col_beg - 1]) - (0 if fmt & 0x10000 else 1)
+    if fmt & 0xffff == TBI_FORMAT_VCF:
+        end = beg + len(fields[3])
+        # Use the END of symbolic alleles / reference blocks
+        info = fields[7] if len(fields) > 7 else ''
+        if info.startswith('END='):
+            info_end = info[4:]
+        elif ';END=' in info:
+            info_end = info.split(';END=', 1)[1]
+        else:
+            info_end = ''
+        info_end = info_end.split(';', 1)[0]
+        if info_end.isdigit() and int(info_end) > beg:
+            end = int(info_end)
+    elif col_end and col_end != col_beg:
+        end = int(fields[col_end - 1])
+    else:
+        end = beg + 1
+    return fields[col_seq - 1], beg, end
+
+
+def filter_regions(lines, regions, conf=VCF_CONF):
+    """Keep the lines overlapping the regions [(contig, beg, end)]
+    """
+    merged = merge_regions(regions)
+    starts = {contig: [beg for beg, _ in intervals]
+              for contig, intervals in merged.items()}
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        contig, beg, end = line_span(line.split('\t', 8), conf)
+        if contig not in merged:
+            continue
+        # The last region starting before the end of the line
+        i = bisect_right(starts[contig], end - 1) - 1
+        if i >= 0 and merged[contig][i][1] > beg:
+            yield line
+
+
+def header_contigs(lines):
+    """The contig names of the ##contig lines, in header order
+    """
+    return [line.split('ID=')[1].split(',')[0].split('>')[0].strip()
+            for line in lines if line.startswith('##contig=')]
+
+
+def find_index(name, exts=('.tbi', '.csi')):
+    """Path of the .tbi or .csi index (or the other extensions) of a file, or
+    None
+    """
+    for ext in exts:
+        if os.path.exists(name + ext):
+            return name + ext
+    return None
+
+
+def fetch(name, regions, conf=VCF_CONF):
+    """Yield the lines overlapping the regions [(contig, beg, end)] once, in
+    file order within a contig. Seek with the .tbi / .csi index if it
+    exists, otherwise scan the file
+    """
+    index_name = find_index(name) if is_compressed(name) else None
+    if index_name is None:
+        with open_vcf(name) as f:
+            yield from filter_regions(f, regions, conf)
+        return
+
+    index = TabixIndex(index_name)
+    merged = merge_regions(regions)
+    with BgzfReader(name) as reader:
+        for contig in index.contigs:
+            if contig not in merged:
+                continue
+            # Lines overlapping several regions are only returned once
+            last = -1
+            for beg, end in merged[contig]:
+                for start, stop in index.chunks(contig, beg, end):
+                    reader.seek(max(start, last))
+                    while reader.tell() < stop:
+                        offset, line = reader.tell(), reader.readline()
+                        if not line:
+                            break
+                        line = line.decode()
+                        if line.startswith('#'):
+                            continue
+                        l_contig, l_beg, l_end = line_span(
+                            line.split('\t', 8), index.conf)
+                        # The indexed lines are sorted: the rest of the
+                        # chunk starts after the region
+                        if l_contig == contig and l_beg >= end:
+                            break
+                        if l_contig == contig and l_beg < end and \
+                           l_end > beg and offset > last:
+                            last = offset
+                            yield line
+
+
+def read_vcf(name, regions=None):
+    """Yield the header lines, then the variant lines of a vcf (only those
+    overlapping the regions, if given)
+    """
+    with open_vcf(name) as f:
+        for line in f:
+            yield line
+            if not line.startswith('##'):
+                break
+        if regions is None:
+            yield from f
+            return
+    yield from fetch(name, regions)
+
+
+def read_header(vcf):
+    """The header lines of a vcf (a name, or a file read from its start), up
+    to the #CHROM line
+    """
+    if isinstance(vcf, str):
+        with open_vcf(vcf) as f:
+            return read_header(f)
+    header = []
+    for line in vcf:
+        header.append(line)
+        if not line.startswith('##'):
+            break
+    return header
+
+
+def record_chunks(vcf, chunk_size=MAP_CHUNK_SIZE):
+    """Yield the records of a vcf (a name, or a file read up to its records),
+    in lists of about chunk_size bytes
+    """
+    if isinstance(vcf, str):
+        with open_vcf(vcf) as f:
+            read_header(f)
+            yield from record_chunks(f, chunk_size)
+        return
+    line = next(vcf, '')
+    while line:
+        yield [line] + vcf.readlines(chunk_size)
+        line = next(vcf, '')
+
+
+def record_ranges(name, chunk_size=MAP_CHUNK_SIZE):
+    """The byte ranges [(start, end)] of about chunk_size bytes covering the
+    records of an uncompressed vcf, each ending after a newline
+    """
+    if not os.path.getsize(name):
+        return []
+    with open(name, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        size, start = len(m), 0
+        # The header ends after the #CHROM line
+        while start < size:
+            line_start, start = start, m.find(b'\n', start) + 1 or size
+            if m[line_start:line_start + 2] != b'##':
+                break
+        ranges = []
+        while start < size:
+            end = m.find(b'\n', start + chunk_size - 1) + 1 or size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _map_range(job):
+    """Transform the records in a byte range of an uncompressed vcf
+    """
+    name, start, end, transform, args = job
+    with open(name, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        text = m[start:end].decode()
+    # Universal newlines, as reading through open_vcf
+    return transform(io.StringIO(text, newline=None).readlines(), *args)
+
+
+def _map_lines(job):
+    lines, transform, args = job
+    return transform(lines, *args)
+
+
+def map_records(vcf, transform, args=(), threads=1,
+                chunk_size=MAP_CHUNK_SIZE):
+    """Yield transform(lines, *args) for the chunks of records (the lines
+    after the header) of a vcf, in order. vcf is a name, or a file read up to
+    its records (e.g. the standard input)
+    With threads > 1, the chunks are transformed in a pool of processes
+    (transform must be a module-level function), with at most 2 chunks per
+    process in flight. The byte ranges of an uncompressed vcf file are read
+    by the workers from the memory-mapped file, the chunks of a compressed
+    vcf or a stream are read by this process
+    """
+    if threads == 1:
+        for lines in record_chunks(vcf, chunk_size):
+            yield transform(lines, *args)
+        return
+    if not isinstance(vcf, str) or is_compressed(vcf):
+        jobs = ((_map_lines, (lines, transform, args))
+                for lines in record_chunks(vcf, chunk_size))
+    else:
+        jobs = ((_map_range, (vcf, start, end, transform, args))
+                for start, end in record_ranges(vcf, chunk_size))
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for function, job in jobs:
+            pending.append(pool.submit(function, job))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def external_sort(lines, key, max_memory, tmp_dir=None, keep=False):
+    """Yield the lines sorted by key(line), stable, each ending in a newline
+    (added if missing). Runs of up to max_memory
+    bytes of lines are sorted in memory, and written to gzip files in a
+    temporary directory in tmp_dir when there is more than one run. The
+    runs are then merged back. The directory is deleted at the end, unless
+    keep is set
+    """
+    run, size, runs = [], 0, []
+    run_dir = None
+    try:
+        for line in lines:
+            # The lines are read back from the runs split at newlines
+            if not line.endswith('\n'):
+                line += '\n'
+            run.append(line)
+            size += len(line) + SORT_LINE_OVERHEAD
+            if size >= max_memory:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix='sort.', dir=tmp_dir)
+                run.sort(key=key)
+                runs.append(os.path.join(run_dir, '{}.gz'.format(len(runs))))
+                with gzip.open(runs[-1], 'wt', compresslevel=1) as f:
+                    f.writelines(run)
+                run, size = [], 0
+        run.sort(key=key)
+        if not runs:
+            yield from run
+            return
+
+        # The last run is merged from memory
+        run_files = [gzip.open(name, 'rt') for name in runs]
+        try:
+            yield from heapq.merge(*run_files, run, key=key)
+        finally:
+            for f in run_files:
+                f.close()
+    finally:
+        if run_dir is not None:
+            if keep:
+                print("Sorted runs kept in {}".format(run_dir),
+                      file=sys.stderr)
+            else:
+                shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def compress_block(data):
+    """Compress up to BGZF_BLOCK_SIZE bytes into one BGZF block
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    return (BGZF_HEADER + struct.pack('<H', len(cdata) + 25) + cdata +
+            struct.pack('<II', zlib.crc32(data), len(data)))
+
+##############################################################################
+
+
+class TabixIndexer:
+    """Build a tabix index for the vcf records written to a BGZF file
+    Records must be sorted, otherwise no index is written
+    The virtual offsets added may count the blocks instead of their
+    compressed offsets, given to write once known
+    """
+
+    def __init__(self):
+        self.contigs = OrderedDict()
+        self.sorted = True
+        self._last = None
+
+    def add(self, line, start, end):
+        """Add a vcf line, written between the virtual offsets start and end
+        """
+        if line.startswith('#') or not self.sorted:
+            return
+        contig, beg, stop = line_span(line.split('\t', 8))
+
+        if contig != (self._last[0] if self._last else None):
+            if contig in self.contigs:
+                self.sorted = False
+                return
+            # bins, linear index, [first offset, last offset, records]
+            self.contigs[contig] = (OrderedDict(), [], [start, end, 0])
+        elif beg < self._last[1]:
+            self.sorted = False
+            return
+        self._last = (contig, beg)
+
+        bins, linear, meta = self.contigs[contig]
+        chunks = bins.setdefault(reg2bin(beg, stop), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        for window in range(beg >> TBI_MIN_SHIFT,
+                            ((stop - 1) >> TBI_MIN_SHIFT) + 1):
+            if window >= len(linear):
+                linear.extend([None] * (window + 1 - len(linear)))
+            if linear[window] is None:
+                linear[window] = start
+        meta[1] = end
+        meta[2] += 1
+
+    def write(self, name, offsets=None):
+        """Write the index to file name (BGZF compressed)
+        offsets: the compressed offset of each block, if the virtual offsets
+        added count the blocks
+        """
+        if offsets is not None:
+            self._relocate(offsets)
+        names = b''.join(contig.encode() + b'\0' for contig in self.contigs)
+        data = [b'TBI\1', struct.pack('<iiiiiii', len(self.contigs),
+                                       TBI_FORMAT_VCF, 1, 2, 0, ord('#'), 0),
+                struct.pack('<i', len(names)), names]
+        for bins, linear, meta in self.contigs.values():
+            data.append(struct.pack('<i', len(bins) + 1))
+            for bin_, chunks in bins.items():
+                data.append(struct.pack('<Ii', bin_, len(chunks)))
+                data += [struct.pack('<QQ', *chunk) for chunk in chunks]
+            data.append(struct.pack('<IiQQQQ', TBI_PSEUDO_BIN, 2, meta[0],
+                                    meta[1], meta[2], 0))
+            # Empty windows point to the next record (leading windows) or
+            # the previous record
+            for i in range(len(linear)):
+                if linear[i] is None:
+                    linear[i] = linear[i - 1] if i else meta[0]
+            data.append(struct.pack('<i', len(linear)))
+            data += [struct.pack('<Q', offset) for offset in linear]
+        data.append(struct.pack('<Q', 0))
+        with BgzfWriter(name, index=False) as f:
+            f.write_bytes(b''.join(data))
+
+    def _relocate(self, offsets):
+        """Replace the block numbers of the virtual offsets by the compressed
+        offsets of the blocks
+        """
+        def relocate(voffset):
+            return (offsets[voffset >> 16] << 16) | (voffset & 0xffff)
+
+        for bins, linear, meta in self.contigs.values():
+            for chunks in bins.values():
+                for chunk in chunks:
+                    chunk[:] = map(relocate, chunk)
+            linear[:] = [None if offset is None else relocate(offset)
+                         for offset in linear]
+            meta[:2] = map(relocate, meta[:2])
+
+
+class BgzfWriter:
+    """Text file object writing BGZF blocks, and (by default) the tabix index
+    of the vcf lines to name + '.tbi' on close
+    The text is cut into blocks of BGZF_BLOCK_SIZE bytes, compressed on a pool
+    of threads (up to BGZF_QUEUE blocks in flight) and written in order. The
+    index counts the blocks until their compressed offsets are known
+    """
+
+    def __init__(self, name, index=True, threads=BGZF_THREADS):
+        self.name = name
+        self._f = open(name, 'wb')
+        self._block = bytearray()
+        # Bytes written, and the compressed offset of each block written
+        self._size = 0
+        self._offsets = [0]
+        self._pending = ''
+        self._queue = deque()
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._index = TabixIndexer() if index else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self):
+        """Virtual offset of the next byte written, counting the blocks
+        """
+        return self._voffset(self._size)
+
+    @staticmethod
+    def _voffset(size):
+        return ((size // BGZF_BLOCK_SIZE) << 16) | (size % BGZF_BLOCK_SIZE)
+
+    def write(self, text):
+        if self._index is None:
+            self.write_bytes(text.encode())
+            return
+        text = self._pending + text
+        lines = text.split('\n')
+        self._pending = lines.pop()
+        if not lines:
+            return
+        # The byte length of the ascii lines is their length
+        ascii = text.isascii()
+        size = self._size
+        for line in lines:
+            end = size + 1 + (len(line) if ascii else len(line.encode()))
+            self._index.add(line, self._voffset(size), self._voffset(end))
+            size = end
+        lines.append('')
+        self.write_bytes('\n'.join(lines).encode())
+
+    def write_bytes(self, data):
+        self._block += data
+        self._size += len(data)
+        while len(self._block) >= BGZF_BLOCK_SIZE:
+            self._flush_block(self._block[:BGZF_BLOCK_SIZE])
+            del self._block[:BGZF_BLOCK_SIZE]
+
+    def _flush_block(self, data):
+        """Queue the block for compression, and write the compressed blocks
+        that are ready, in order
+        """
+        self._queue.append(self._pool.submit(compress_block, bytes(data)))
+        while self._queue and (self._queue[0].done() or
+                               len(self._queue) >= BGZF_QUEUE):
+            self._write_block(self._queue.popleft().result())
+
+    def _write_block(self, block):
+        self._f.write(block)
+        self._offsets.append(self._offsets[-1] + len(block))
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._pending:
+            self.write('\n')
+        if self._block:
+            self._flush_block(self._block)
+            self._block = bytearray()
+        while self._queue:
+            self._write_block(self._queue.popleft().result())
+        self._pool.shutdown()
+        self._f.write(BGZF_EOF)
+        self._f.close()
+        if self._index is not None:
+            if self._index.sorted:
+                self._index.write(self.name + '.tbi', self._offsets)
+            else:
+                print("Warning: {} is not sorted, the .tbi index was not \
+written".format(self.name), file=sys.stderr)
+
+
+class BgzfReader:
+    """Binary reader of a BGZF file, with seek / tell by virtual offset
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._f = open(name, 'rb')
+        self._block_offset, self._next_offset = 0, 0
+        self._data, self._within = b'', 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _load_block(self, offset):
+        """Read and inflate the block at the compressed offset
+        Output False at the end of the file
+        """
+        self._f.seek(offset)
+        header = self._f.read(18)
+        self._block_offset, self._within = offset, 0
+        if len(header) < 18:
+            self._data, self._next_offset = b'', offset
+            return False
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        cdata = self._f.read(block_size - 18)
+        self._data = zlib.decompress(cdata[:-8], -15)
+        self._next_offset = offset + block_size
+        return True
+
+    def seek(self, voffset):
+        if voffset >> 16 != self._block_offset or not self._data:
+            self._load_block(voffset >> 16)
+        self._within = voffset & 0xffff
+
+    def tell(self):
+        """Virtual offset of the next byte read
+        """
+        if self._data and self._within == len(self._data):
+            return self._next_offset << 16
+        return (self._block_offset << 16) | self._within
+
+    def read(self, size):
+        """Read size bytes (fewer at the end of the file)
+        """
+        pieces = []
+        while size > 0:
+            if self._within >= len(self._data):
+                if not self._load_block(self._next_offset):
+                    break
+                continue
+            piece = self._data[self._within:self._within + size]
+            self._within += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return b''.join(pieces)
+
+    def readline(self):
+        """Read a line (bytes, with the newline), or b'' at the end of file
+        """
+        pieces = []
+        while True:
+            if self._within >= len(self._data):
+                if not self._load_block(self._next_offset):
+                    return b''.join(pieces)
+                continue
+            end = self._data.find(b'\n', self._within)
+            if end == -1:
+                pieces.append(self._data[self._within:])
+                self._within = len(self._data)
+            else:
+                pieces.append(self._data[self._within:end + 1])
+                self._within = end + 1
+                return b''.join(pieces)
+
+    def close(self):
+        self._f.close()
+
+
+def inflate_block(cdata):
+    """Inflate the compressed data and the CRC32 / size trailer of a BGZF
+    block, checking the trailer
+    """
+    data = zlib.decompress(cdata[:-8], -15)
+    crc, size = struct.unpack('<II', cdata[-8:])
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise OSError('Corrupt BGZF block')
+    return data
+
+
+class BgzfBlockStream(io.RawIOBase):
+    """Binary stream of the content of a BGZF file, read sequentially
+    The blocks are inflated on a pool of threads, up to BGZF_QUEUE blocks
+    ahead of the reader, and returned in order
+    """
+
+    def __init__(self, name, threads=BGZF_THREADS):
+        self.name = name
+        self._f = open(name, 'rb')
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._data, self._within = memoryview(b''), 0
+        self._end = False
+        self._fill()
+
+    def _fill(self):
+        """Submit the next blocks to the pool, up to BGZF_QUEUE
+        """
+        while not self._end and len(self._pending) < BGZF_QUEUE:
+            header = self._f.read(18)
+            if len(header) < 18:
+                self._end = True
+                break
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            cdata = self._f.read(block_size - 18)
+            self._pending.append(self._pool.submit(inflate_block, cdata))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._within >= len(self._data):
+            if not self._pending:
+                return 0
+            self._data = memoryview(self._pending.popleft().result())
+            self._within = 0
+            self._fill()
+        size = min(len(buffer), len(self._data) - self._within)
+        buffer[:size] = self._data[self._within:self._within + size]
+        self._within += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            self._f.close()
+        super().close()
+
+
+class TabixIndex:
+    """Tabix (.tbi), CSI (.csi) or BAM (.bai) index of a BGZF file
+    The contig names of a .bai, or of the .csi of a BAM, are given from the
+    BAM header
+    Attributes:
+    conf: (format, col_seq, col_beg, col_end), None for a BAM
+    contigs: {contig: ({bin: (loffset, [(start, end)])}, linear index)}
+    """
+
+    def __init__(self, name, names=None):
+        with open(name, 'rb') as f:
+            data = f.read()
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        magic = data[:4]
+        self.conf = None
+        if magic == b'BAI\1' and names is not None:
+            self.min_shift, self.depth = TBI_MIN_SHIFT, TBI_DEPTH
+            n_ref = struct.unpack_from('<i', data, 4)[0]
+            offset = 8
+        elif magic == b'TBI\1':
+            self.min_shift, self.depth = TBI_MIN_SHIFT, TBI_DEPTH
+            offset = 4
+            n_ref = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            offset, names = self._read_conf(data, offset)
+        elif magic == b'CSI\1':
+            self.min_shift, self.depth, l_aux = struct.unpack_from('<iii',
+                                                                  data, 4)
+            if names is None:
+                if l_aux < 28:
+                    sys.exit("Index {} has no contig names, it is not a \
+tabix style CSI index".format(name))
+                _, names = self._read_conf(data, 16)
+            n_ref = struct.unpack_from('<i', data, 16 + l_aux)[0]
+            offset = 20 + l_aux
+        else:
+            sys.exit("File {} is not a tabix, CSI or BAM index".format(name))
+
+        self.contigs = OrderedDict()
+        for contig in names[:n_ref]:
+            bins = {}
+            n_bin = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            for _ in range(n_bin):
+                if magic != b'CSI\1':
+                    bin_, n_chunk = struct.unpack_from('<Ii', data, offset)
+                    loffset = 0
+                    offset += 8
+                else:
+                    bin_, loffset, n_chunk = struct.unpack_from('<IQi', data,
+                                                                offset)
+                    offset += 16
+                chunks = struct.unpack_from('<' + 'Q' * 2 * n_chunk, data,
+                                            offset)
+                offset += 16 * n_chunk
+                bins[bin_] = (loffset, list(zip(chunks[::2], chunks[1::2])))
+            linear = ()
+            if magic != b'CSI\1':
+                n_intv = struct.unpack_from('<i', data, offset)[0]
+                linear = struct.unpack_from('<' + 'Q' * n_intv, data,
+                                            offset + 4)
+                offset += 4 + 8 * n_intv
+            self.contigs[contig] = (bins, linear)
+
+    def _read_conf(self, data, offset):
+        """Read the tabix configuration and the contig names
+        """
+        fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+            struct.unpack_from('<iiiiiii', data, offset)
+        offset += 28
+        self.conf = (fmt, col_seq, col_beg, col_end)
+        names = data[offset:offset + l_nm].split(b'\0')[:-1]
+        return offset + l_nm, [name.decode() for name in names]
+
+    def pseudo_bin(self):
+        """Bin holding the (first offset, last offset) of each contig
+        """
+        return ((1 << 3 * (self.depth + 1)) - 1) // 7 + 1
+
+    def span(self, contig):
+        """(first, last) virtual offsets of the records of a contig
+        """
+        bins, _ = self.contigs[contig]
+        if self.pseudo_bin() in bins:
+            return bins[self.pseudo_bin()][1][0]
+        chunks = [chunk for bin_, (_, c) in bins.items() for chunk in c]
+        return (min(c[0] for c in chunks), max(c[1] for c in chunks))
+
+    def chunks(self, contig, beg, end):
+        """The merged (start, end) virtual offsets to read for a region
+        """
+        if contig not in self.contigs:
+            return []
+        bins, linear = self.contigs[contig]
+        # Smallest offset of the records overlapping the region
+        min_off = 0
+        if linear:
+            min_off = linear[min(beg >> self.min_shift, len(linear) - 1)]
+        else:
+            bin_ = reg2bin(beg, beg + 1, self.min_shift, self.depth)
+            while bin_ not in bins and bin_ > 0:
+                bin_ = (bin_ - 1) >> 3
+            if bin_ in bins:
+                min_off = bins[bin_][0]
+        chunks = sorted(chunk for bin_ in reg2bins(beg, end, self.min_shift,
+                                                   self.depth)
+                        if bin_ in bins and bin_ != self.pseudo_bin()
+                        for chunk in bins[bin_][1] if chunk[1] > min_off)
+        merged = []
+        for start, stop in chunks:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+            else:
+                merged.append((max(start, min_off), stop))
+        return merged